@@ -0,0 +1,154 @@
+"""ASGI entry point serving the Flask routes over async SQLAlchemy engines.
+
+    uvicorn asgi:application
+
+Every request runs the unchanged Flask view inside greenlet_spawn with
+Session / ReadSession routed to create_async_engine(...).sync_engine, the
+same mechanism AsyncSession.run_sync uses. Database I/O therefore awaits
+on the event loop instead of holding a thread, and the routes, validation,
+caching and JSON contracts stay exactly those of app.py.
+"""
+import io
+import os
+import sys
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.util import greenlet_spawn
+from app import app
+from db import DATABASE_READ_URL, DATABASE_URL, dialect_pool_options, use_engines
+from metrics import instrument_engine
+
+# 同步 driver 對應的 async driver
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+def async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+def make_async_engine(url, name='write'):
+    _, options = dialect_pool_options(url)
+    statement_timeout_ms = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout_ms and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(statement_timeout_ms)}}
+    async_engine = create_async_engine(url, **options)
+    instrument_engine(async_engine, name)
+    return async_engine
+
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or async_url(DATABASE_URL)
+ASYNC_DATABASE_READ_URL = os.getenv('ASYNC_DATABASE_READ_URL') or async_url(DATABASE_READ_URL)
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+class AsyncApp:
+    """Minimal ASGI-to-WSGI bridge that keeps the Flask app's database work on the event loop."""
+
+    def __init__(self, wsgi_app, write_url, read_url):
+        # wsgi_app 為 Flask app 本身，套在 app.wsgi_app 上的 middleware 也會生效
+        self.wsgi_app = wsgi_app
+        self.write_url = write_url
+        self.read_url = read_url
+        self.write_engine = None
+        self.read_engine = None
+
+    def start(self):
+        if self.write_engine is None:
+            self.write_engine = make_async_engine(make_url(self.write_url))
+            same = make_url(self.read_url) == make_url(self.write_url)
+            self.read_engine = self.write_engine if same else make_async_engine(make_url(self.read_url), 'read')
+
+    async def dispose(self):
+        if self.write_engine is not None:
+            await self.write_engine.dispose()
+            if self.read_engine is not self.write_engine:
+                await self.read_engine.dispose()
+            self.write_engine = self.read_engine = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            self.start()
+            await self.http(scope, receive, send)
+        else:
+            raise RuntimeError(f"unsupported ASGI scope type {scope['type']}")
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+        def call(fn, *args):
+            with use_engines(self.write_engine.sync_engine, self.read_engine.sync_engine):
+                return fn(*args)
+
+        environ = wsgi_environ(scope, body)
+        app_iter = await greenlet_spawn(call, self.wsgi_app, environ, start_response)
+        try:
+            chunks = await greenlet_spawn(call, iter, app_iter)
+            # 串流回應（例如 /search?format=ndjson）逐塊在 greenlet 內產生，查詢仍走 async engine
+            chunk = await greenlet_spawn(call, next, chunks, None)
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await greenlet_spawn(call, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                await greenlet_spawn(call, close)
+
+application = AsyncApp(app, ASYNC_DATABASE_URL, ASYNC_DATABASE_READ_URL)
@@ -0,0 +1,317 @@
+"""Endpoint benchmark: throughput and latency percentiles with a baseline gate.
+
+    python benchmark.py --scale 50 --concurrency 8 --requests 400 --output bench.json
+    python benchmark.py --output bench.json --save-baseline benchmarks/baseline.json
+    python benchmark.py --output bench.json --baseline benchmarks/baseline.json
+
+Unless --skip-load is given, a dataset from generate_data.py is loaded with
+etl.py into --database-url, a throwaway SQLite file by default. Every
+route in app.py except GET /metrics (the Prometheus scrape endpoint) is
+then driven through the Flask test client in worker threads, or over HTTP
+when --base-url points at a running server. Per-route results go to
+--output as JSON. With --baseline the run exits with status 1 when a
+route's p95 latency or throughput regresses by more than the thresholds,
+when any request fails, or when a route completed no requests.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROUTES = [
+    'GET /pharmacies/open',
+    'GET /pharmacies/<name>/masks',
+    'GET /pharmacies/mask_count',
+    'GET /users/top_by_transaction_amount',
+    'GET /masks/stats',
+    'GET /search',
+    'POST /purchase',
+]
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+    }
+
+def compare(results, baseline, max_latency_increase=0.25, max_throughput_drop=0.2):
+    """Return a message for every route that failed or regressed against the baseline."""
+    problems = []
+    for route, current in results['routes'].items():
+        if current['errors']:
+            problems.append(f"{route}: {current['errors']} failed requests")
+        if current['p95_ms'] is None or current['throughput_rps'] is None:
+            problems.append(f"{route}: no completed requests")
+            continue
+        previous = baseline.get('routes', {}).get(route)
+        if not previous:
+            continue
+        if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + max_latency_increase):
+            problems.append(f"{route}: p95 {current['p95_ms']:.2f} ms vs baseline {previous['p95_ms']:.2f} ms")
+        if previous['throughput_rps'] and current['throughput_rps'] < previous['throughput_rps'] * (1 - max_throughput_drop):
+            problems.append(
+                f"{route}: {current['throughput_rps']:.1f} req/s vs baseline {previous['throughput_rps']:.1f} req/s"
+            )
+    return problems
+
+class RequestPlan:
+    """Seeded request generator for every route, built from the rows in the database."""
+
+    def __init__(self, pharmacies, masks, user_ids, dates, seed=0):
+        # pharmacies: [name]；masks: [(mask_id, pharmacy_id)]；dates: (第一天, 最後一天)
+        self.pharmacies = pharmacies
+        self.masks = masks
+        self.user_ids = user_ids
+        self.first_day, self.last_day = dates
+        self.seed = seed
+        self._local = threading.local()
+        self._streams = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_database(cls, session, seed=0):
+        """Raises ValueError when there are no pharmacies, masks or users to build requests from."""
+        from sqlalchemy import func, select
+        from models import Mask, Pharmacy, PurchaseHistory, User
+        first, last = session.execute(
+            select(func.min(PurchaseHistory.transaction_date), func.max(PurchaseHistory.transaction_date))
+        ).one()
+        plan = cls(
+            session.execute(select(Pharmacy.name).order_by(Pharmacy.id)).scalars().all(),
+            session.execute(select(Mask.id, Mask.pharmacy_id).order_by(Mask.id)).all(),
+            session.execute(select(User.id).order_by(User.id)).scalars().all(),
+            (first.date(), last.date()) if first else (datetime(2021, 1, 1).date(),) * 2,
+            seed
+        )
+        empty = [label for label, rows in (('pharmacies', plan.pharmacies), ('masks', plan.masks), ('users', plan.user_ids)) if not rows]
+        if empty:
+            raise ValueError(f"no {', '.join(empty)} in the database to build requests from")
+        return plan
+
+    @property
+    def rng(self):
+        # 每個執行緒各自一條固定的亂數序列，不共用同一個 Random 的鎖
+        rng = getattr(self._local, 'rng', None)
+        if rng is None:
+            with self._lock:
+                stream = next(self._streams)
+            rng = self._local.rng = random.Random(f'{self.seed}:{stream}')
+        return rng
+
+    def date_range(self):
+        span = (self.last_day - self.first_day).days
+        start = self.rng.randint(0, span)
+        end = self.rng.randint(start, span)
+        return (self.first_day + timedelta(days=start)).isoformat(), (self.first_day + timedelta(days=end)).isoformat()
+
+    def request(self, route):
+        """Return (method, path, json body, headers) for one request to `route`."""
+        rng = self.rng
+        if route == 'GET /pharmacies/open':
+            day = rng.choice(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'])
+            return 'GET', f'/pharmacies/open?day={day}&time={rng.randrange(24):02d}:{rng.randrange(60):02d}', None, {}
+        if route == 'GET /pharmacies/<name>/masks':
+            name = urllib.request.quote(rng.choice(self.pharmacies))
+            sort_by, order = rng.choice(['name', 'price']), rng.choice(['asc', 'desc'])
+            return 'GET', f'/pharmacies/{name}/masks?sort_by={sort_by}&order={order}', None, {}
+        if route == 'GET /pharmacies/mask_count':
+            low = rng.randint(0, 40)
+            threshold = rng.choice(['gt', 'lt'])
+            return 'GET', f'/pharmacies/mask_count?min_price={low}&max_price={low + 10}&count=2&threshold={threshold}', None, {}
+        if route == 'GET /users/top_by_transaction_amount':
+            start, end = self.date_range()
+            return 'GET', f'/users/top_by_transaction_amount?start_date={start}&end_date={end}&x=10', None, {}
+        if route == 'GET /masks/stats':
+            start, end = self.date_range()
+            return 'GET', f'/masks/stats?start_date={start}&end_date={end}', None, {}
+        if route == 'GET /search':
+            query = rng.choice(self.pharmacies + ['Mask', 'blue', 'pack'])[:rng.randint(3, 8)]
+            return 'GET', f'/search?query={urllib.request.quote(query)}&limit=20', None, {}
+        if route == 'POST /purchase':
+            mask_id, pharmacy_id = rng.choice(self.masks)
+            body = {'user_id': rng.choice(self.user_ids), 'items': [{'pharmacy_id': pharmacy_id, 'mask_id': mask_id, 'quantity': 1}]}
+            return 'POST', '/purchase', body, {'Idempotency-Key': str(uuid.uuid4())}
+        raise ValueError(f'unknown route {route}')
+
+# 餘額或庫存不足是預期中的業務結果，不算失敗
+EXPECTED_STATUS = {'POST /purchase': (200, 400, 409)}
+
+def client_sender(app):
+    local = threading.local()
+
+    def send(method, path, body, headers):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers)
+        response.get_data()
+        return response.status_code
+    return send
+
+def http_sender(base_url, timeout=30):
+    def send(method, path, body, headers):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(base_url.rstrip('/') + path, data=data, method=method, headers=dict(
+            headers, **({'Content-Type': 'application/json'} if data is not None else {})
+        ))
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+    return send
+
+def run_route(send, plan, route, requests, concurrency, warmup=0):
+    expected = EXPECTED_STATUS.get(route, (200,))
+    for _ in range(warmup):
+        send(*plan.request(route))
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            request = plan.request(route)
+            started = time.perf_counter()
+            try:
+                ok = send(*request) in expected
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+def format_number(value, width, precision=2):
+    # 沒有完成任何請求時百分位數與吞吐量為 None
+    return f'{value:>{width}.{precision}f}' if value is not None else f"{'-':>{width}}"
+
+def run_benchmark(send, plan, routes=ROUTES, requests=200, concurrency=4, warmup=10):
+    results = {}
+    for route in routes:
+        result = results[route] = run_route(send, plan, route, requests, concurrency, warmup)
+        print(f"{route:<40}{format_number(result['throughput_rps'], 10, 1)} req/s"
+              f"  p50 {format_number(result['p50_ms'], 8)}  p95 {format_number(result['p95_ms'], 8)}"
+              f"  p99 {format_number(result['p99_ms'], 8)} ms  errors {result['errors']}")
+    return results
+
+def load_dataset(database_url, scale, seed):
+    # 子行程執行，避免 etl.py 的模組層級連線沿用到基準測試
+    env = dict(os.environ, DATABASE_URL=database_url)
+    with tempfile.TemporaryDirectory() as out_dir:
+        subprocess.run([sys.executable, 'generate_data.py', '--scale', str(scale), '--seed', str(seed), '--out-dir', out_dir],
+                       check=True, env=env)
+        subprocess.run([sys.executable, 'etl.py', '--bulk', '--stream',
+                        '--pharmacies', os.path.join(out_dir, 'pharmacies.json'),
+                        '--users', os.path.join(out_dir, 'users.json')], check=True, env=env)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every route and compare against a baseline.')
+    parser.add_argument('--database-url', help='database to load and query (default: a temporary SQLite file)')
+    parser.add_argument('--skip-load', action='store_true', help='use the data already in --database-url')
+    parser.add_argument('--scale', type=float, default=20, help='generate_data.py --scale for the loaded dataset (default: 20)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--base-url', help='benchmark a running server over HTTP instead of the in-process test client')
+    parser.add_argument('--route', action='append', choices=ROUTES, help='only benchmark these routes (repeatable)')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route (default: 200)')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients (default: 4)')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per route (default: 10)')
+    parser.add_argument('--response-cache', choices=['on', 'off'], default='off',
+                        help='in-process response cache; off measures the handlers themselves (default: off)')
+    parser.add_argument('--output', default='benchmark_results.json', help='results JSON (default: benchmark_results.json)')
+    parser.add_argument('--baseline', help='fail if results regress against this results JSON')
+    parser.add_argument('--save-baseline', help='also write the results to this path')
+    parser.add_argument('--max-latency-increase', type=float, default=0.25,
+                        help='allowed p95 increase over the baseline, as a fraction (default: 0.25)')
+    parser.add_argument('--max-throughput-drop', type=float, default=0.2,
+                        help='allowed throughput decrease from the baseline, as a fraction (default: 0.2)')
+    args = parser.parse_args()
+
+    if args.database_url is None:
+        args.database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench-'), 'bench.db')}"
+    if not args.skip_load:
+        load_dataset(args.database_url, args.scale, args.seed)
+    # db.py 在匯入時讀取 DATABASE_URL
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('DATABASE_READ_URL', args.database_url)
+    from app import app
+    from db import ReadSession
+
+    with ReadSession() as session:
+        try:
+            plan = RequestPlan.from_database(session, args.seed)
+        except ValueError as e:
+            sys.exit(f"{args.database_url}: {e}; load data first or drop --skip-load")
+    if args.base_url:
+        send = http_sender(args.base_url)
+    else:
+        app.config['RESPONSE_CACHE'] = args.response_cache == 'on'
+        send = client_sender(app)
+    routes = args.route or ROUTES
+    results = {
+        'meta': {
+            'started_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+            'target': args.base_url or 'in-process',
+            'database': args.database_url.split(':', 1)[0],
+            'scale': args.scale,
+            'seed': args.seed,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'response_cache': args.response_cache,
+            'python': platform.python_version(),
+        },
+        'routes': run_benchmark(send, plan, routes, args.requests, args.concurrency, args.warmup),
+    }
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Results written to {path}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = compare(results, json.load(f), args.max_latency_increase, args.max_throughput_drop)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+if __name__ == '__main__':
+    main()
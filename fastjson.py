@@ -0,0 +1,32 @@
+"""JSON encoding for response bodies: orjson when it is installed, the stdlib json module otherwise.
+
+Both backends produce what jsonify does (sorted keys, compact separators,
+trailing newline), except that non-ASCII text is written as UTF-8 rather
+than \\u escapes.
+"""
+import json
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+def default(value):
+    # PostgreSQL NUMERIC 欄位可能回傳 Decimal
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE
+
+    def dumps(obj):
+        """Serialize `obj` to UTF-8 encoded JSON bytes followed by a newline."""
+        return orjson.dumps(obj, default=default, option=_OPTIONS)
+else:
+    def dumps(obj):
+        """Serialize `obj` to UTF-8 encoded JSON bytes followed by a newline."""
+        return (json.dumps(obj, default=default, sort_keys=True, separators=(',', ':'), ensure_ascii=False) + '\n').encode('utf-8')
@@ -0,0 +1,198 @@
+"""Generate a scaled synthetic dataset shaped like data/pharmacies.json and data/users.json.
+
+    python generate_data.py --scale 1000 --seed 1 --out-dir data/generated
+    python etl.py --bulk --stream --pharmacies data/generated/pharmacies.json --users data/generated/users.json
+
+Counts, prices, balances, opening-hours strings and purchase dates are
+drawn from the distributions observed in the sample files. Every
+pharmacy and user is derived from its own seeded generator, so purchases
+can refer to any pharmacy's masks without keeping the catalogue in memory
+and the output is streamed record by record at any size.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+PHARMACIES_JSON = 'data/pharmacies.json'
+USERS_JSON = 'data/users.json'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+MASK_NAME = re.compile(r'^(.+) \((\w+)\) \((\d+) per pack\)$')
+
+# 除了樣本中出現的寫法，再組合 parse_opening_hours 需要處理的各種格式：
+# 區間（Mon - Fri）、逗號列表、四字縮寫（Thur）、跨午夜時段、以 / 分隔的多個區塊
+DAY_SPECS = ['Mon - Fri', 'Mon - Wed', 'Fri - Sun', 'Sat, Sun', 'Mon, Wed, Fri', 'Tue, Thur', 'Thur, Sat', 'Sun']
+PERIODS = ['08:00 - 12:00', '08:00 - 17:00', '09:00 - 21:00', '14:00 - 18:00', '20:00 - 02:00', '22:00 - 06:00']
+
+class SampleProfile:
+    """Distributions measured on the sample pharmacies and users."""
+
+    def __init__(self, pharmacies, users):
+        self.pharmacy_names = [p['name'] for p in pharmacies]
+        self.user_names = [u['name'] for u in users]
+        self.pharmacy_balance = min_max(p['cashBalance'] for p in pharmacies)
+        self.user_balance = min_max(u['cashBalance'] for u in users)
+        self.mask_counts = [len(p['masks']) for p in pharmacies]
+        self.purchase_counts = [len(u['purchaseHistories']) for u in users]
+        self.opening_hours = sorted({p['openingHours'] for p in pharmacies})
+        brands, colors, packs, unit_prices = set(), set(), set(), []
+        for p in pharmacies:
+            for mask in p['masks']:
+                match = MASK_NAME.match(mask['name'])
+                if match:
+                    brands.add(match.group(1))
+                    colors.add(match.group(2))
+                    packs.add(int(match.group(3)))
+                    unit_prices.append(mask['price'] / int(match.group(3)))
+        self.brands, self.colors, self.packs = sorted(brands), sorted(colors), sorted(packs)
+        self.unit_price = min_max(unit_prices)
+        dates = [datetime.strptime(h['transactionDate'], DATE_FORMAT) for u in users for h in u['purchaseHistories']]
+        self.first_date = min(dates)
+        self.date_span = int((max(dates) - self.first_date).total_seconds()) + 1
+        # 交易金額相對於口罩售價的比例
+        prices = {(p['name'], m['name']): m['price'] for p in pharmacies for m in p['masks']}
+        ratios = [
+            h['transactionAmount'] / prices[(h['pharmacyName'], h['maskName'])]
+            for u in users for h in u['purchaseHistories'] if (h['pharmacyName'], h['maskName']) in prices
+        ]
+        self.amount_ratio = min_max(ratios) if ratios else (1.0, 1.0)
+
+    @classmethod
+    def load(cls, pharmacies_path=PHARMACIES_JSON, users_path=USERS_JSON):
+        with open(pharmacies_path, encoding='utf-8') as f:
+            pharmacies = json.load(f)
+        with open(users_path, encoding='utf-8') as f:
+            users = json.load(f)
+        return cls(pharmacies, users)
+
+def min_max(values):
+    values = list(values)
+    return min(values), max(values)
+
+def unique_name(names, i):
+    # 名稱有唯一索引：超過樣本數量後加上序號
+    base = names[i % len(names)]
+    return base if i < len(names) else f'{base} {i // len(names) + 1}'
+
+class DatasetGenerator:
+    def __init__(self, profile, pharmacies, users, seed=0):
+        self.profile = profile
+        self.pharmacy_count = pharmacies
+        self.user_count = users
+        self.seed = seed
+        self.mask_kinds = [
+            (brand, color, pack) for brand in profile.brands for color in profile.colors for pack in profile.packs
+        ]
+        # 購買紀錄需要藥局的口罩清單，重新產生即可，快取最近用到的部分
+        self.pharmacy = lru_cache(maxsize=4096)(self._pharmacy)
+
+    def rng(self, kind, i):
+        return random.Random(f'{self.seed}:{kind}:{i}')
+
+    def opening_hours(self, rng):
+        if rng.random() < 0.5:
+            return rng.choice(self.profile.opening_hours)
+        blocks = rng.sample(DAY_SPECS, rng.choice([1, 1, 2]))
+        return ' / '.join(f'{days} {rng.choice(PERIODS)}' for days in blocks)
+
+    def _pharmacy(self, i):
+        rng = self.rng('pharmacy', i)
+        profile = self.profile
+        masks = []
+        count = min(rng.choice(profile.mask_counts), len(self.mask_kinds))
+        for brand, color, pack in rng.sample(self.mask_kinds, count):
+            masks.append({
+                'name': f'{brand} ({color}) ({pack} per pack)',
+                'price': round(pack * rng.uniform(*profile.unit_price), 2),
+            })
+        return {
+            'name': unique_name(profile.pharmacy_names, i),
+            'cashBalance': round(rng.uniform(*profile.pharmacy_balance), 2),
+            'openingHours': self.opening_hours(rng),
+            'masks': masks,
+        }
+
+    def user(self, i):
+        rng = self.rng('user', i)
+        profile = self.profile
+        count = min(rng.choice(profile.purchase_counts), profile.date_span)
+        histories = []
+        # 同一使用者的交易時間不重複（etl.py 以「名稱|交易時間」為自然鍵）
+        for offset in sorted(rng.sample(range(profile.date_span), count)):
+            pharmacy = self.pharmacy(rng.randrange(self.pharmacy_count))
+            mask = rng.choice(pharmacy['masks'])
+            histories.append({
+                'pharmacyName': pharmacy['name'],
+                'maskName': mask['name'],
+                'transactionAmount': round(mask['price'] * rng.uniform(*profile.amount_ratio), 2),
+                'transactionDate': (profile.first_date + timedelta(seconds=offset)).strftime(DATE_FORMAT),
+            })
+        return {
+            'name': unique_name(profile.user_names, i),
+            'cashBalance': round(rng.uniform(*profile.user_balance), 2),
+            'purchaseHistories': histories,
+        }
+
+    def pharmacies(self):
+        for i in range(self.pharmacy_count):
+            yield self.pharmacy(i)
+
+    def users(self):
+        for i in range(self.user_count):
+            yield self.user(i)
+
+def write_json_array(path, records):
+    """Write records as a JSON array, one element per line; return the number written."""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for record in records:
+            f.write(',\n' if count else '\n')
+            f.write(json.dumps(record, ensure_ascii=False))
+            count += 1
+        f.write('\n]\n')
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a scaled synthetic pharmacies/users dataset for etl.py.')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiple of the sample record counts (default: 1)')
+    parser.add_argument('--pharmacies', type=int, help='number of pharmacies (default: sample count x scale)')
+    parser.add_argument('--users', type=int, help='number of users (default: sample count x scale)')
+    parser.add_argument('--purchases', type=int,
+                        help='approximate number of purchases; sets --users from the sample purchases per user')
+    parser.add_argument('--seed', type=int, default=0, help='random seed; the same seed gives the same files (default: 0)')
+    parser.add_argument('--out-dir', default='data/generated', help='output directory (default: data/generated)')
+    parser.add_argument('--sample-pharmacies', default=PHARMACIES_JSON)
+    parser.add_argument('--sample-users', default=USERS_JSON)
+    args = parser.parse_args()
+
+    profile = SampleProfile.load(args.sample_pharmacies, args.sample_users)
+    pharmacies = args.pharmacies or max(1, round(len(profile.pharmacy_names) * args.scale))
+    users = args.users or max(1, round(len(profile.user_names) * args.scale))
+    if args.purchases:
+        mean_purchases = sum(profile.purchase_counts) / len(profile.purchase_counts)
+        users = max(1, round(args.purchases / mean_purchases))
+    generator = DatasetGenerator(profile, pharmacies, users, args.seed)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    started = time.perf_counter()
+    purchases = 0
+
+    def counted(users):
+        nonlocal purchases
+        for user in users:
+            purchases += len(user['purchaseHistories'])
+            yield user
+
+    for name, records in (('pharmacies.json', generator.pharmacies()), ('users.json', counted(generator.users()))):
+        path = os.path.join(args.out_dir, name)
+        count = write_json_array(path, records)
+        print(f"{path}: {count} records ({time.perf_counter() - started:.2f}s)")
+    print(f"purchase histories: {purchases}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Production server settings: gunicorn -c gunicorn.conf.py
+
+The application is imported and warmed up once in the master
+(preload_app), so the opening-hours and search indexes are shared
+copy-on-write by every forked worker. Workers then drop the inherited
+connection pools and open their own. The master handles graceful
+restarts: HUP replaces workers one by one, and TERM lets in-flight
+requests finish within graceful_timeout. Because the app is preloaded,
+a HUP does not pick up new code; deploy new code with a full restart.
+"""
+import gc
+import multiprocessing
+import os
+
+# wsgi: app:app（Flask）；ASGI 模式可設 GUNICORN_APP=asgi:application、GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker
+wsgi_app = os.getenv('GUNICORN_APP', 'app:app')
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes', 'on')
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+# 定期換掉 worker 以回收記憶體，jitter 避免所有 worker 同時重啟
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+def when_ready(server):
+    # preload_app 時 app 已在 master 載入，這裡只建立索引，不會重新匯入
+    from app import warm_up
+    from db import dispose_engines
+    warm_up()
+    # master 不處理請求，建立索引用的連線不能留給 worker 共用
+    dispose_engines()
+    # 把目前的物件移出 GC 追蹤，避免 worker 的 GC 觸碰共享頁面而失去 copy-on-write
+    gc.freeze()
+
+def post_fork(server, worker):
+    from db import dispose_engines
+    # 只丟棄從 master 繼承的連線池，不關閉 master 的連線
+    dispose_engines(close=False)
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import threading
+import time
+from sqlalchemy import delete, select, update
+from models import IdempotencyKey
+from rollups import dialect_insert
+
+MAX_KEY_LENGTH = 255
+
+def request_fingerprint(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def claim_key(session, key, fingerprint, now, ttl):
+    """Claim `key` in the caller's transaction.
+
+    Returns None when this request owns the key and should run; the claim
+    is committed or rolled back together with the purchase. Otherwise
+    returns the stored IdempotencyKey row. On PostgreSQL a concurrent
+    duplicate blocks on the INSERT until the first transaction finishes,
+    so it sees the final response rather than a half-done purchase.
+    """
+    stmt = dialect_insert(session, IdempotencyKey).values(
+        key=key, request_hash=fingerprint, created_at=now
+    ).on_conflict_do_nothing(index_elements=['key']).returning(IdempotencyKey.key)
+    if session.execute(stmt).first():
+        return None
+    stored = session.execute(select(IdempotencyKey).where(IdempotencyKey.key == key)).scalar_one()
+    if stored.created_at < now - ttl:
+        # 過期的 key 視為新請求，以條件式 UPDATE 接手避免兩個請求同時接手
+        taken = session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key, IdempotencyKey.created_at == stored.created_at)
+            .values(request_hash=fingerprint, created_at=now, status_code=None, response_body=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if taken:
+            return None
+        session.refresh(stored)
+    return stored
+
+def store_response(session, key, status_code, body):
+    session.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key)
+        .values(status_code=status_code, response_body=json.dumps(body))
+        .execution_options(synchronize_session=False)
+    )
+
+def purge_expired_keys(session, cutoff):
+    return session.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff)).rowcount
+
+class PurgeSchedule:
+    """Tells callers when an opportunistic purge is due, at most once per `interval` seconds."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def due(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next:
+                return False
+            self._next = now + self.interval
+            return True
@@ -0,0 +1,276 @@
+"""In-process request, SQL and connection-pool metrics in Prometheus text format.
+
+Counters and histograms live in this process, so under gunicorn every
+worker reports its own series; scrape each worker or aggregate them in
+Prometheus. Timings for the request in progress are kept in a ContextVar,
+which lets the SQL listeners attribute statements to the request that ran
+them.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labels), 0)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, key)} {format_value(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._lock = threading.Lock()
+        # key -> [每個 bucket 的次數（非累計）, 總和, 次數]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels):
+        state = self._values.get(tuple(labels[name] for name in self.labels))
+        return state[2] if state else 0
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.labels, key, [('le', format_value(bound))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}')
+                lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+class Gauge:
+    """Gauge whose samples are read from `callback` at scrape time as {label values: value}."""
+
+    def __init__(self, name, documentation, labels, callback):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for key, value in sorted(self.callback().items()):
+            lines.append(f'{self.name}{format_labels(self.labels, key)} {format_value(value)}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def unregister(self, metric):
+        self._metrics.remove(metric)
+
+    def exposition(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'Time from request start until the view returned a response.',
+    ('method', 'route', 'status')))
+RESPONSE_SIZE = REGISTRY.register(Histogram(
+    'http_response_size_bytes', 'Size of non-streamed response bodies.', ('route',), SIZE_BUCKETS))
+REQUEST_SQL_STATEMENTS = REGISTRY.register(Histogram(
+    'http_request_sql_statements', 'SQL statements executed per request.', ('route',), COUNT_BUCKETS))
+REQUEST_PHASE = REGISTRY.register(Histogram(
+    'http_request_phase_seconds', 'Per-request time spent in SQL execution and JSON serialization.', ('route', 'phase')))
+SQL_STATEMENTS = REGISTRY.register(Counter(
+    'sql_statements_total', 'SQL statements executed.', ('engine', 'operation')))
+SQL_DURATION = REGISTRY.register(Histogram(
+    'sql_statement_duration_seconds', 'Time from cursor execute to completion.', ('engine', 'operation')))
+POOL_WAIT = REGISTRY.register(Histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection, including connects.', ('engine',)))
+
+# 目前請求的累計值：{'sql_statements': ..., 'sql_seconds': ..., 'serialize_seconds': ...}
+_request_stats = ContextVar('request_stats', default=None)
+
+def start_request():
+    """Begin collecting per-request SQL and serialization timings; returns a token for finish_request()."""
+    return _request_stats.set({'sql_statements': 0, 'sql_seconds': 0.0, 'serialize_seconds': 0.0})
+
+def finish_request(token, method, route, status, duration, size=None):
+    stats = _request_stats.get()
+    _request_stats.reset(token)
+    REQUEST_DURATION.observe(duration, method=method, route=route, status=str(status))
+    if size is not None:
+        RESPONSE_SIZE.observe(size, route=route)
+    if stats is not None:
+        REQUEST_SQL_STATEMENTS.observe(stats['sql_statements'], route=route)
+        REQUEST_PHASE.observe(stats['sql_seconds'], route=route, phase='sql')
+        REQUEST_PHASE.observe(stats['serialize_seconds'], route=route, phase='serialize')
+    return stats
+
+def discard_request(token):
+    _request_stats.reset(token)
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to the current request's `<phase>_seconds`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = _request_stats.get()
+        if stats is not None:
+            key = f'{phase}_seconds'
+            stats[key] = stats.get(key, 0.0) + time.perf_counter() - started
+
+def statement_operation(statement):
+    word = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+    return word if word in ('select', 'insert', 'update', 'delete', 'with') else 'other'
+
+def instrument_engine(engine, name):
+    """Count and time every statement executed through `engine` under the label `name`."""
+    target = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(target, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(target, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+        operation = statement_operation(statement)
+        SQL_STATEMENTS.inc(engine=name, operation=operation)
+        SQL_DURATION.observe(elapsed, engine=name, operation=operation)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats['sql_statements'] += 1
+            stats['sql_seconds'] += elapsed
+
+    @event.listens_for(target, 'handle_error')
+    def handle_error(context):
+        # 失敗的語句不會觸發 after_cursor_execute，丟棄它的起始時間
+        started = context.connection.info.get('metrics_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    return target
+
+class QueryCounter:
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+@contextmanager
+def count_queries(*engines):
+    """Collect the statements executed through `engines` inside the block.
+
+    Each cursor execute counts once, so an executemany batch is a single
+    statement. Engines listed more than once are only counted once.
+    """
+    counter = QueryCounter()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter.statements.append(statement)
+
+    targets = list({id(target): target for target in (getattr(e, 'sync_engine', e) for e in engines)}.values())
+    for target in targets:
+        event.listen(target, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        for target in targets:
+            event.remove(target, 'before_cursor_execute', before_cursor_execute)
+
+class TimedPool:
+    """Pool mixin that records how long each checkout waited in db_pool_checkout_wait_seconds.
+
+    The engine label is the pool's logging name (create_engine's
+    pool_logging_name), which recreate() carries over after dispose().
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started, engine=self._orig_logging_name or 'default')
+
+class TimedQueuePool(TimedPool, QueuePool):
+    pass
+
+_timed_pool_classes = {QueuePool: TimedQueuePool}
+
+def timed_pool_class(pool_class):
+    """The TimedPool subclass of `pool_class`, e.g. SingletonThreadPool for sqlite:// keeps its behaviour."""
+    timed = _timed_pool_classes.get(pool_class)
+    if timed is None:
+        timed = _timed_pool_classes[pool_class] = type(f'Timed{pool_class.__name__}', (TimedPool, pool_class), {})
+    return timed
+
+def sql_summary(engine_name):
+    """Statement count and total seconds recorded for `engine_name`, e.g. for etl.py's report."""
+    count = sum(SQL_STATEMENTS.value(engine=engine_name, operation=op) for op in ('select', 'insert', 'update', 'delete', 'with', 'other'))
+    seconds = 0.0
+    with SQL_DURATION._lock:
+        for key, (_, total, _) in SQL_DURATION._values.items():
+            if key[0] == engine_name:
+                seconds += total
+    return count, seconds
@@ -0,0 +1,141 @@
+"""Microbenchmark of the list endpoints' query and serialization paths.
+
+    python microbench.py --pharmacies 2000 --masks-per-pharmacy 50
+
+Each endpoint is timed twice on the same in-memory SQLite data: the
+previous implementation (ORM entities, float() per row, jsonify) and the
+current one (Core rows with only the needed columns, fastjson). HTTP
+routing and the response cache are left out so only the measured work
+differs.
+
+/search shows little or no gain: almost all of its time is the two
+ILIKE '%q%' scans over every pharmacy and mask name and the rank sort,
+which both implementations run identically. The serialization saved is
+a few milliseconds out of that; the n-gram backend (SEARCH_BACKEND=ngram)
+is what shortens the scan for selective queries.
+"""
+import argparse
+import json
+import random
+import timeit
+from flask import jsonify
+from sqlalchemy import create_engine, insert, or_
+from sqlalchemy.pool import StaticPool
+from app import (
+    app, format_search_mask, format_search_pharmacy, json_response, pharmacy_masks_query,
+    query_open_pharmacies, search_masks, search_pharmacies, search_rank
+)
+from db import ReadSession, use_engines
+import fastjson
+from models import Base, Mask, Pharmacy
+
+def load_data(engine, pharmacies, masks_per_pharmacy, seed=0):
+    rng = random.Random(seed)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Pharmacy), [
+            {'id': i, 'name': f'Pharmacy {i}', 'cash_balance': round(rng.uniform(0, 5000), 2),
+             'opening_hours': 'Mon, Wed, Fri 08:00 - 12:00 / Tue, Thu 14:00 - 18:00'}
+            for i in range(1, pharmacies + 1)
+        ])
+        conn.execute(insert(Mask), [
+            {'name': f'Mask {rng.choice(["Green", "Blue", "Black"])} ({j + 1} per pack)',
+             'price': round(rng.uniform(1, 50), 2), 'stock': rng.randint(0, 100), 'pharmacy_id': i}
+            for i in range(1, pharmacies + 1)
+            for j in range(masks_per_pharmacy)
+        ])
+
+# 舊版實作：載入 ORM 物件、逐列 float()，再交給 jsonify
+def orm_open_pharmacies():
+    with ReadSession() as session:
+        pharmacies = session.query(Pharmacy).order_by(Pharmacy.id).all()
+        return jsonify([
+            {'id': p.id, 'name': p.name, 'cash_balance': float(p.cash_balance), 'opening_hours': p.opening_hours}
+            for p in pharmacies
+        ]).get_data()
+
+def core_open_pharmacies():
+    with ReadSession() as session:
+        return json_response(query_open_pharmacies(session, None, None)).get_data()
+
+def orm_pharmacy_masks(name):
+    with ReadSession() as session:
+        pharmacy = session.query(Pharmacy).filter(Pharmacy.name == name).first()
+        masks = (
+            session.query(Mask)
+            .filter(Mask.pharmacy_id == pharmacy.id, or_(Mask.stock.is_(None), Mask.stock > 0))
+            .order_by(Mask.price.asc(), Mask.id.asc())
+        )
+        return jsonify([{'id': m.id, 'name': m.name, 'price': float(m.price), 'stock': m.stock} for m in masks]).get_data()
+
+def core_pharmacy_masks(name):
+    with ReadSession() as session:
+        pharmacy_id = session.query(Pharmacy.id).filter(Pharmacy.name == name).scalar()
+        rows = session.execute(pharmacy_masks_query(pharmacy_id, 'price', 'asc', True))
+        return json_response([row._asdict() for row in rows]).get_data()
+
+def orm_search(query, limit):
+    with ReadSession() as session:
+        pharmacy_rank = search_rank(Pharmacy.name, query)
+        pharmacies = (
+            session.query(Pharmacy)
+            .filter(Pharmacy.name.ilike(f'%{query}%'))
+            .order_by(pharmacy_rank, Pharmacy.name, Pharmacy.id)
+            .limit(limit)
+        )
+        mask_rank = search_rank(Mask.name, query)
+        masks = (
+            session.query(Mask, Pharmacy.name)
+            .join(Pharmacy, Mask.pharmacy_id == Pharmacy.id)
+            .filter(Mask.name.ilike(f'%{query}%'))
+            .order_by(mask_rank, Mask.name, Mask.id)
+            .limit(limit)
+        )
+        return jsonify({
+            'pharmacies': [
+                {'id': p.id, 'name': p.name, 'cash_balance': float(p.cash_balance), 'opening_hours': p.opening_hours}
+                for p in pharmacies
+            ],
+            'masks': [
+                {'id': m.id, 'name': m.name, 'price': float(m.price), 'pharmacy_name': pharmacy_name}
+                for m, pharmacy_name in masks
+            ],
+        }).get_data()
+
+def core_search(query, limit):
+    with ReadSession() as session:
+        pharmacies = search_pharmacies(session, query, Pharmacy.name.ilike(f'%{query}%'), limit - 1, None)
+        masks = search_masks(session, query, Mask.name.ilike(f'%{query}%'), limit - 1, None)
+        return json_response({
+            'pharmacies': [format_search_pharmacy(row) for row in pharmacies],
+            'masks': [format_search_mask(row) for row in masks],
+        }).get_data()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pharmacies', type=int, default=2000)
+    parser.add_argument('--masks-per-pharmacy', type=int, default=50)
+    parser.add_argument('--search-limit', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    load_data(engine, args.pharmacies, args.masks_per_pharmacy)
+    name = f'Pharmacy {args.pharmacies // 2}'
+    cases = [
+        ('/pharmacies/open', orm_open_pharmacies, core_open_pharmacies),
+        ('/pharmacies/<name>/masks', lambda: orm_pharmacy_masks(name), lambda: core_pharmacy_masks(name)),
+        ('/search', lambda: orm_search('a', args.search_limit), lambda: core_search('a', args.search_limit)),
+    ]
+    print(f'JSON backend: {fastjson.BACKEND}')
+    print(f"{'endpoint':<28}{'orm+jsonify ms':>16}{'core+fastjson ms':>18}{'speedup':>10}")
+    with app.test_request_context(), use_engines(engine, engine):
+        for endpoint, legacy, fast in cases:
+            # 兩種實作的內容必須相同，速度比較才有意義
+            assert fastjson.dumps(json.loads(legacy())) == fastjson.dumps(json.loads(fast())), endpoint
+            legacy_ms = min(timeit.repeat(legacy, number=1, repeat=args.repeat)) * 1000
+            fast_ms = min(timeit.repeat(fast, number=1, repeat=args.repeat)) * 1000
+            print(f'{endpoint:<28}{legacy_ms:>16.2f}{fast_ms:>18.2f}{legacy_ms / fast_ms:>9.1f}x')
+
+if __name__ == '__main__':
+    main()
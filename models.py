@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import CheckConstraint, Column, Integer, String, Float, Date, DateTime, ForeignKey, Index, JSON
 from sqlalchemy.orm import relationship, declarative_base
 
+# 唯一的資料表定義；建立與升級資料庫請用 schema.py 的 migrations
 Base = declarative_base()
 
 class Pharmacy(Base):
@@ -8,22 +9,40 @@ class Pharmacy(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String)
     cash_balance = Column(Float)
-    opening_hours = Column(String)
+    opening_hours = Column(JSON)
+    # etl.py --incremental 用來判斷資料是否異動
+    content_hash = Column(String(40))
     masks = relationship("Mask", back_populates="pharmacy")
+    opening_periods = relationship("OpeningPeriod", back_populates="pharmacy")
+    __table_args__ = (Index('ux_pharmacies_name', 'name', unique=True),)
 
 class Mask(Base):
     __tablename__ = 'masks'
     id = Column(Integer, primary_key=True)
     name = Column(String)
     price = Column(Float)
+    # 庫存數量，NULL 表示不追蹤庫存（不限量）
+    stock = Column(Integer)
     pharmacy_id = Column(Integer, ForeignKey('pharmacies.id'))
+    content_hash = Column(String(40))
     pharmacy = relationship("Pharmacy", back_populates="masks")
-    
+    __table_args__ = (
+        CheckConstraint('stock >= 0', name='ck_masks_stock'),
+        # 自然鍵，也涵蓋只依 pharmacy_id 的查詢
+        Index('ux_masks_pharmacy_id_name', 'pharmacy_id', 'name', unique=True),
+        # /pharmacies/<name>/masks?sort_by=price 依藥局篩選後按價格排序
+        Index('ix_masks_pharmacy_id_price', 'pharmacy_id', 'price'),
+        # /pharmacies/mask_count 的價格區間
+        Index('ix_masks_price', 'price'),
+    )
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     name = Column(String)
     cash_balance = Column(Float)
+    content_hash = Column(String(40))
+    __table_args__ = (Index('ux_users_name', 'name', unique=True),)
 
 class PurchaseHistory(Base):
     __tablename__ = 'purchase_history'
@@ -32,4 +51,71 @@ class PurchaseHistory(Base):
     mask_id = Column(Integer, ForeignKey('masks.id'))
     pharmacy_id = Column(Integer, ForeignKey('pharmacies.id'))
     transaction_amount = Column(Float)
-    transaction_date = Column(String)
\ No newline at end of file
+    transaction_date = Column(DateTime)
+    # ETL 匯入的自然鍵（使用者名稱|交易時間），由 /purchase 寫入的紀錄為 NULL
+    source_key = Column(String)
+    content_hash = Column(String(40))
+    __table_args__ = (
+        Index('ux_purchase_history_source_key', 'source_key', unique=True),
+        # 依日期重建彙總表
+        Index('ix_purchase_history_transaction_date', 'transaction_date'),
+        # 單一使用者的交易紀錄
+        Index('ix_purchase_history_user_id_transaction_date', 'user_id', 'transaction_date'),
+    )
+
+class OpeningPeriod(Base):
+    # opening_hours 正規化後的營業時段，分鐘數包含頭尾，跨午夜的時段拆成兩筆
+    __tablename__ = 'opening_periods'
+    id = Column(Integer, primary_key=True)
+    pharmacy_id = Column(Integer, ForeignKey('pharmacies.id'), nullable=False)
+    weekday = Column(Integer, nullable=False)
+    start_minute = Column(Integer, nullable=False)
+    end_minute = Column(Integer, nullable=False)
+    pharmacy = relationship("Pharmacy", back_populates="opening_periods")
+    __table_args__ = (
+        Index('ix_opening_periods_weekday_start_end', 'weekday', 'start_minute', 'end_minute', 'pharmacy_id'),
+    )
+
+class MaskSalesDaily(Base):
+    # purchase_history 依日期、藥局、口罩彙總，供 /masks/stats 使用
+    __tablename__ = 'mask_sales_daily'
+    day = Column(Date, primary_key=True)
+    pharmacy_id = Column(Integer, ForeignKey('pharmacies.id'), primary_key=True)
+    mask_id = Column(Integer, ForeignKey('masks.id'), primary_key=True)
+    tx_count = Column(Integer, nullable=False, default=0)
+    amount_sum = Column(Float, nullable=False, default=0)
+
+class UserSpend(Base):
+    # 使用者每日（period_kind='day'）與每月（'month'）消費彙總，供 /users/top_by_transaction_amount 使用
+    __tablename__ = 'user_spend'
+    period_kind = Column(String(5), primary_key=True)
+    period_start = Column(Date, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    tx_count = Column(Integer, nullable=False, default=0)
+    amount_sum = Column(Float, nullable=False, default=0)
+    __table_args__ = (
+        Index('ix_user_spend_period_amount', 'period_kind', 'period_start', 'amount_sum'),
+    )
+
+class IdempotencyKey(Base):
+    # POST /purchase 的 Idempotency-Key 與最終回應，超過保存期限後清除
+    __tablename__ = 'idempotency_keys'
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(40), nullable=False)
+    status_code = Column(Integer)
+    response_body = Column(String)
+    created_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index('ix_idempotency_keys_created_at', 'created_at'),)
+
+class DataVersion(Base):
+    # 各類資料的版本號，寫入時遞增，供各 worker 的回應快取判斷是否失效
+    __tablename__ = 'data_versions'
+    name = Column(String(32), primary_key=True)
+    version = Column(Integer, nullable=False)
+
+class SchemaVersion(Base):
+    # 已套用的 schema.py migration
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False)
@@ -0,0 +1,222 @@
+from bisect import bisect_right
+from datetime import datetime
+import logging
+import re
+import threading
+
+weekday_map = {
+    "Mon": "Monday",
+    "Tue": "Tuesday",
+    "Wed": "Wednesday",
+    "Thu": "Thursday",
+    "Fri": "Friday",
+    "Sat": "Saturday",
+    "Sun": "Sunday",
+}
+
+WEEKDAYS = list(weekday_map.keys())
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+def expand_days(day_str):
+    try:
+        if not day_str.strip():
+            return []
+        parts = [s.strip() for s in day_str.split(",") if s.strip()]
+        result = []
+        keys = list(weekday_map.keys())
+        for part in parts:
+            if "-" in part:
+                start, end = [d.strip() for d in part.split("-")]
+                start_idx = keys.index(start)
+                end_idx = keys.index(end) + 1
+                result.extend(keys[start_idx:end_idx])
+            else:
+                result.append(part)
+        return result
+    except Exception as e:
+        logging.warning(f"expand_days parsing error: {e}")
+        return []
+
+def parse_opening_hours(time_string):
+    if not time_string:
+        return {}
+    blocks = [b.strip() for b in time_string.split("/")]
+    schedule = {}
+    for block in blocks:
+        match = re.match(r"(.+?)\s+(\d{2}:\d{2})\s*-\s*(\d{2}:\d{2})", block)
+        if match:
+            days_part, start_time, end_time = match.groups()
+            days = expand_days(days_part)
+            for day in days:
+                schedule.setdefault(day, []).append({"start": start_time, "end": end_time})
+        else:
+            logging.warning(f"Opening hours block format not matched: {block}")
+    return schedule
+
+def is_open(schedule, day_code, check_time_str):
+    check_time = datetime.strptime(check_time_str, "%H:%M").time()
+    periods = schedule.get(day_code, [])
+    for period in periods:
+        start = datetime.strptime(period["start"], "%H:%M").time()
+        end = datetime.strptime(period["end"], "%H:%M").time()
+        if start <= end:
+            if start <= check_time <= end:
+                return True
+        else:
+            if check_time >= start or check_time <= end:
+                return True
+    return False
+
+def day_index(day):
+    # 與 is_pharmacy_open 相同的正規化方式：取前三碼，例如 monday -> Mon
+    day_code = day.lower()[:3].capitalize()
+    if day_code not in weekday_map:
+        return None
+    return WEEKDAYS.index(day_code)
+
+def to_minute(time_str):
+    t = datetime.strptime(time_str, "%H:%M").time()
+    return t.hour * 60 + t.minute
+
+def compile_periods(time_string):
+    """Return the schedule as (weekday, start_minute, end_minute) tuples.
+
+    Both ends are inclusive. A period that wraps past midnight (e.g.
+    20:00 - 02:00) is split into two ranges on the same weekday, which is
+    how is_open has always evaluated it.
+    """
+    periods = []
+    for day_code, day_periods in parse_opening_hours(time_string).items():
+        if day_code not in weekday_map:
+            logging.warning(f"Unknown weekday in opening hours: {day_code}")
+            continue
+        weekday = WEEKDAYS.index(day_code)
+        for period in day_periods:
+            try:
+                start = to_minute(period["start"])
+                end = to_minute(period["end"])
+            except ValueError as e:
+                logging.warning(f"Invalid opening hours period {period}: {e}")
+                continue
+            if start <= end:
+                periods.append((weekday, start, end))
+            else:
+                periods.append((weekday, start, MINUTES_PER_DAY - 1))
+                periods.append((weekday, 0, end))
+    return sorted(set(periods))
+
+def compile_bitmap(time_string):
+    # 一週 7 * 1440 分鐘，每分鐘一個 bit
+    bitmap = bytearray(MINUTES_PER_WEEK // 8)
+    for weekday, start, end in compile_periods(time_string):
+        for minute in range(weekday * MINUTES_PER_DAY + start, weekday * MINUTES_PER_DAY + end + 1):
+            bitmap[minute >> 3] |= 1 << (minute & 7)
+    return bytes(bitmap)
+
+class ScheduleIndex:
+    """Minute-of-week bitmaps for every pharmacy, compiled once.
+
+    `loader` returns the pharmacy rows (objects with id, name, cash_balance
+    and opening_hours). The index is built lazily on first lookup and again
+    after invalidate() is called, so a lookup costs one bit test per
+    pharmacy and never touches the database while the index is fresh.
+    `fields_loader`, if given, returns {id: {field: value}} for fields that
+    change without affecting the bitmaps (cash_balance); after
+    invalidate_fields() they are reloaded instead of recompiling every
+    schedule.
+    """
+
+    def __init__(self, loader, fields_loader=None):
+        self._loader = loader
+        self._fields_loader = fields_loader
+        self._lock = threading.Lock()
+        # 同一時間只有一個執行緒讀取並編譯全部藥局，其他執行緒等它完成
+        self._build_lock = threading.Lock()
+        self._state = None
+        self._fields_stale = False
+        # invalidate() / invalidate_fields() 各自遞增，讀取期間有變更時不保存過期的結果
+        self._generation = 0
+        self._fields_generation = 0
+
+    def build(self):
+        with self._build_lock:
+            return self._build()
+
+    def _build(self):
+        with self._lock:
+            generation, fields_generation = self._generation, self._fields_generation
+        entries = []
+        for p in sorted(self._loader(), key=lambda p: p.id):
+            row = {'id': p.id, 'name': p.name, 'cash_balance': float(p.cash_balance), 'opening_hours': p.opening_hours}
+            entries.append((row, compile_bitmap(p.opening_hours)))
+        state = (entries, [row['id'] for row, _ in entries])
+        with self._lock:
+            if self._generation == generation:
+                self._state = state
+                self._fields_stale = self._fields_generation != fields_generation
+        return state
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+            self._generation += 1
+
+    def invalidate_fields(self):
+        if self._fields_loader is None:
+            self.invalidate()
+            return
+        with self._lock:
+            self._fields_generation += 1
+            self._fields_stale = self._state is not None
+
+    def update_rows(self, changes):
+        """Patch cached row fields in place, e.g. {pharmacy_id: {'cash_balance': 12.5}}."""
+        with self._lock:
+            if self._state is None:
+                return
+            entries, ids = self._state
+            for row_id, fields in changes.items():
+                i = bisect_right(ids, row_id) - 1
+                if i >= 0 and ids[i] == row_id:
+                    entries[i][0].update(fields)
+
+    @property
+    def is_built(self):
+        return self._state is not None
+
+    def _get_state(self):
+        entries = self._state
+        if entries is None:
+            with self._build_lock:
+                # 等待期間其他執行緒可能已經建好
+                entries = self._state
+                if entries is None:
+                    return self._build()
+        if self._fields_stale:
+            # 先清除旗標再讀取：讀取期間的新變更會再次設定旗標
+            with self._lock:
+                self._fields_stale = False
+            self.update_rows(self._fields_loader())
+        return entries
+
+    def iter_open(self, day, check_time, after_id=None):
+        """Yield rows of pharmacies open at day/check_time in id order, starting after after_id."""
+        entries, ids = self._get_state()
+        start = bisect_right(ids, after_id) if after_id is not None else 0
+        if not day:
+            for row, _ in entries[start:]:
+                yield row
+            return
+        weekday = day_index(day)
+        if weekday is None:
+            return
+        minute = weekday * MINUTES_PER_DAY + check_time.hour * 60 + check_time.minute
+        byte, bit = minute >> 3, 1 << (minute & 7)
+        for i in range(start, len(entries)):
+            row, bitmap = entries[i]
+            if bitmap[byte] & bit:
+                yield row
+
+    def open_at(self, day, check_time):
+        return list(self.iter_open(day, check_time))
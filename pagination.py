@@ -0,0 +1,67 @@
+import base64
+import json
+import math
+from sqlalchemy import and_, or_
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+# cursor 中數值欄位（例如價格）可接受的型別
+NUMBER = (int, float)
+INT_RANGE = 2 ** 63
+
+def valid_value(value, expected):
+    # bool 是 int 的子類別，不能當作 id；超出 BIGINT 或非有限的數值也會讓資料庫查詢失敗
+    if isinstance(value, bool) or not isinstance(value, expected):
+        return False
+    if isinstance(value, int):
+        return -INT_RANGE <= value < INT_RANGE
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+def decode_cursor(token, types):
+    """Decode a cursor made by encode_cursor; raise ValueError unless it holds one value of each of `types`.
+
+    The cursor comes from the client, so every value is checked before it
+    reaches a comparison or a bind parameter.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError('invalid cursor')
+    if not all(valid_value(value, expected) for value, expected in zip(values, types)):
+        raise ValueError('invalid cursor')
+    return values
+
+def keyset_after(columns, values, descending=None):
+    # (c1, c2, ...) 依各欄位排序方向嚴格排在 (v1, v2, ...) 之後
+    descending = descending or [False] * len(columns)
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        after = column < value if descending[i] else column > value
+        clauses.append(and_(*[c == v for c, v in zip(columns[:i], values[:i])], after))
+    return or_(*clauses)
+
+def parse_limit(value, default, maximum):
+    """Parse a `limit` query argument; None means no limit when default is None."""
+    if value is None:
+        return default
+    limit = int(value)
+    if limit <= 0:
+        raise ValueError('limit must be positive')
+    return min(limit, maximum)
+
+def page(rows, limit, cursor_key, cursors, section):
+    """Yield at most `limit` rows; if more exist, store the next cursor in cursors[section]."""
+    cursors[section] = None
+    last = None
+    for count, row in enumerate(rows):
+        if limit is not None and count == limit:
+            cursors[section] = encode_cursor(cursor_key(last))
+            return
+        last = row
+        yield row
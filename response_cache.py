@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import select
+from models import DataVersion
+from rollups import dialect_insert
+
+# 快取標籤：GET 端點依賴的資料，寫入時只失效受影響的標籤
+PHARMACIES = 'pharmacies'        # 藥局名稱、營業時間
+PHARMACY_CASH = 'pharmacy_cash'  # pharmacies.cash_balance
+MASKS = 'masks'                  # 口罩名稱、價格
+MASK_STOCK = 'mask_stock'        # masks.stock
+USERS = 'users'                  # 使用者名稱
+SALES = 'sales'                  # purchase_history 與彙總表
+ALL_TAGS = (PHARMACIES, PHARMACY_CASH, MASKS, MASK_STOCK, USERS, SALES)
+
+def bump_versions(session, tags):
+    """Increment data_versions for `tags` in the caller's transaction and return the new versions."""
+    tags = sorted(set(tags))
+    if not tags:
+        return {}
+    stmt = dialect_insert(session, DataVersion)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'version': DataVersion.version + 1}
+    ).returning(DataVersion.name, DataVersion.version)
+    versions = {}
+    # 依名稱順序逐一更新，讓並行交易以相同順序取得列鎖
+    for tag in tags:
+        name, version = session.execute(stmt.values(name=tag, version=1)).one()
+        versions[name] = version
+    return versions
+
+def read_versions(session):
+    return dict(session.execute(select(DataVersion.name, DataVersion.version)).all())
+
+class CachedResponse:
+    __slots__ = ('body', 'headers', 'mimetype', 'tags', 'expires_at', 'size')
+
+    def __init__(self, body, headers, mimetype, tags, expires_at):
+        self.body = body
+        self.headers = headers
+        self.mimetype = mimetype
+        self.tags = tags
+        self.expires_at = expires_at
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+class ResponseCache:
+    """In-process LRU cache of response bodies with TTL, size limits and tag invalidation.
+
+    Every entry carries the tags of the data it was built from;
+    invalidate(tags) drops only the entries sharing one of them. Other
+    processes (workers, etl.py) bump data_versions instead, and sync()
+    polls that table at most every `poll_interval` seconds to pick up
+    their writes. Callbacks registered with on_change() hear about those
+    writes too, so in-process indexes can be refreshed with the cache.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, ttl=60, poll_interval=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_tag = {}
+        self._generations = {}
+        self._bytes = 0
+        self._versions = None
+        self._last_poll = None
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def generations(self, tags):
+        """Snapshot to pass to set(), taken before the response is built."""
+        with self._lock:
+            return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def versions(self, tags):
+        """data_versions of `tags` as of the last sync(), or None before the first successful poll."""
+        with self._lock:
+            if self._versions is None:
+                return None
+            return tuple(self._versions.get(tag, 0) for tag in tags)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, tags, generations, body, headers=(), mimetype='application/json'):
+        entry = CachedResponse(body, tuple(headers), mimetype, tuple(tags), time.monotonic() + self.ttl)
+        if entry.size > self.max_bytes:
+            return False
+        with self._lock:
+            # 產生回應期間資料已被失效，不能把舊資料放進快取
+            if tuple(self._generations.get(tag, 0) for tag in tags) != tuple(generations):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            for tag in entry.tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+            return True
+
+    def invalidate(self, tags, versions=None):
+        """Drop entries tagged with any of `tags`.
+
+        `versions` are the data_versions this process just committed; pass
+        them only when reads see the primary. With a lagging replica leave
+        them out, so the next sync() invalidates again once the replica
+        has caught up.
+        """
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                for key in list(self._by_tag.get(tag, ())):
+                    self._remove(key)
+            if versions and self._versions is not None:
+                self._versions.update(versions)
+
+    def clear(self):
+        with self._lock:
+            for tag in set(ALL_TAGS) | set(self._generations):
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            self._entries.clear()
+            self._by_tag.clear()
+            self._bytes = 0
+
+    def on_change(self, callback):
+        """Call callback(tags) when sync() sees data_versions changed by other processes.
+
+        `tags` is None on the first poll, when earlier changes are unknown.
+        """
+        self._listeners.append(callback)
+
+    def notify(self, tags):
+        for callback in self._listeners:
+            try:
+                callback(tags)
+            except Exception as e:
+                logging.warning(f"data_versions listener failed: {e}")
+
+    def sync(self, load_versions):
+        """Invalidate tags whose data_versions changed since the last poll."""
+        now = time.monotonic()
+        with self._lock:
+            if self._last_poll is not None and now < self._last_poll + self.poll_interval:
+                return
+            self._last_poll = now
+        try:
+            versions = load_versions()
+        except Exception as e:
+            logging.warning(f"Could not read data_versions: {e}")
+            return
+        with self._lock:
+            previous, self._versions = self._versions, dict(versions)
+        if previous is None:
+            # 第一次讀取版本前建立的項目無法判斷是否過期
+            self.clear()
+            self.notify(None)
+            return
+        changed = [tag for tag, version in versions.items() if version != previous.get(tag)]
+        self.invalidate(changed)
+        if changed:
+            self.notify(changed)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
@@ -0,0 +1,190 @@
+from calendar import monthrange
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from sqlalchemy import Date, and_, cast, delete, func, insert, literal_column, or_, select
+from models import Mask, MaskSalesDaily, PurchaseHistory, User, UserSpend
+
+def dialect_insert(session, model):
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as upsert_insert
+    else:
+        raise RuntimeError(f'upserts are not supported on {dialect}')
+    return upsert_insert(model)
+
+def on_days(column, days):
+    # 先以時間區間篩選（可使用 transaction_date 索引），再比對實際日期；days 需已排序
+    start = datetime.combine(days[0], time.min)
+    end = datetime.combine(days[-1] + timedelta(days=1), time.min)
+    return and_(column >= start, column < end, func.date(column).in_([d.isoformat() for d in days]))
+
+def month_start(session, column):
+    if session.get_bind().dialect.name == 'sqlite':
+        return func.date(column, 'start of month')
+    return cast(func.date_trunc('month', column), Date)
+
+def increment(session, model, key_columns, totals):
+    # totals: {key tuple: [tx_count, amount_sum]}，依主鍵排序讓並行交易以相同順序取得列鎖
+    if not totals:
+        return
+    stmt = dialect_insert(session, model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={
+            'tx_count': model.tx_count + stmt.excluded.tx_count,
+            'amount_sum': model.amount_sum + stmt.excluded.amount_sum,
+        }
+    )
+    session.execute(stmt, [
+        dict(zip(key_columns, key), tx_count=count, amount_sum=amount)
+        for key, (count, amount) in sorted(totals.items())
+    ])
+
+def record_purchases(session, purchases):
+    """Add purchases to the rollup tables inside the caller's transaction.
+
+    purchases is an iterable of dicts with day, user_id, pharmacy_id,
+    mask_id and transaction_amount.
+    """
+    sales = defaultdict(lambda: [0, 0.0])
+    spend = defaultdict(lambda: [0, 0.0])
+    for p in purchases:
+        for total in (
+            sales[(p['day'], p['pharmacy_id'], p['mask_id'])],
+            spend[('day', p['day'], p['user_id'])],
+            spend[('month', p['day'].replace(day=1), p['user_id'])],
+        ):
+            total[0] += 1
+            total[1] += p['transaction_amount']
+    increment(session, MaskSalesDaily, ['day', 'pharmacy_id', 'mask_id'], sales)
+    increment(session, UserSpend, ['period_kind', 'period_start', 'user_id'], spend)
+
+def rebuild_rollups(session, days=None):
+    """Recompute every rollup from purchase_history, for all days or only `days`."""
+    if days is not None:
+        days = sorted(set(days))
+        if not days:
+            return
+    rebuild_sales_rollup(session, days)
+    rebuild_user_spend(session, days)
+
+def rebuild_sales_rollup(session, days=None):
+    day = func.date(PurchaseHistory.transaction_date)
+    # 早期由 /purchase 寫入的紀錄沒有 pharmacy_id，改用口罩所屬藥局
+    pharmacy_id = func.coalesce(PurchaseHistory.pharmacy_id, Mask.pharmacy_id)
+    rollup = delete(MaskSalesDaily)
+    source = (
+        select(
+            day,
+            pharmacy_id,
+            PurchaseHistory.mask_id,
+            func.count(PurchaseHistory.id),
+            func.sum(PurchaseHistory.transaction_amount)
+        )
+        .join(Mask, Mask.id == PurchaseHistory.mask_id)
+        .group_by(day, pharmacy_id, PurchaseHistory.mask_id)
+    )
+    if days is not None:
+        rollup = rollup.where(MaskSalesDaily.day.in_(days))
+        source = source.where(on_days(PurchaseHistory.transaction_date, days))
+    session.execute(rollup)
+    session.execute(
+        insert(MaskSalesDaily).from_select(
+            ['day', 'pharmacy_id', 'mask_id', 'tx_count', 'amount_sum'], source
+        )
+    )
+
+def rebuild_user_spend(session, days=None):
+    day = func.date(PurchaseHistory.transaction_date)
+    day_rows = delete(UserSpend).where(UserSpend.period_kind == 'day')
+    day_source = (
+        select(
+            literal_column("'day'"),
+            day,
+            PurchaseHistory.user_id,
+            func.count(PurchaseHistory.id),
+            func.sum(PurchaseHistory.transaction_amount)
+        )
+        .group_by(day, PurchaseHistory.user_id)
+    )
+    if days is not None:
+        day_rows = day_rows.where(UserSpend.period_start.in_(days))
+        day_source = day_source.where(on_days(PurchaseHistory.transaction_date, days))
+    session.execute(day_rows)
+    session.execute(insert(UserSpend).from_select(
+        ['period_kind', 'period_start', 'user_id', 'tx_count', 'amount_sum'], day_source
+    ))
+
+    # 月彙總由日彙總再加總
+    month = month_start(session, UserSpend.period_start)
+    month_rows = delete(UserSpend).where(UserSpend.period_kind == 'month')
+    month_source = (
+        select(
+            literal_column("'month'"),
+            month,
+            UserSpend.user_id,
+            func.sum(UserSpend.tx_count),
+            func.sum(UserSpend.amount_sum)
+        )
+        .where(UserSpend.period_kind == 'day')
+        .group_by(month, UserSpend.user_id)
+    )
+    if days is not None:
+        months = sorted({d.replace(day=1) for d in days})
+        month_rows = month_rows.where(UserSpend.period_start.in_(months))
+        month_source = month_source.where(month.in_([m.isoformat() for m in months]))
+    session.execute(month_rows)
+    session.execute(insert(UserSpend).from_select(
+        ['period_kind', 'period_start', 'user_id', 'tx_count', 'amount_sum'], month_source
+    ))
+
+def sales_totals(session, start_date, end_date):
+    return session.execute(
+        select(func.sum(MaskSalesDaily.tx_count), func.sum(MaskSalesDaily.amount_sum))
+        .where(MaskSalesDaily.day.between(start_date, end_date))
+    ).one()
+
+def split_periods(start_date, end_date):
+    """Cover [start_date, end_date] with whole calendar months plus leftover days."""
+    months, days = [], []
+    current = start_date
+    while current <= end_date:
+        month_end = current.replace(day=monthrange(current.year, current.month)[1])
+        if current.day == 1 and month_end <= end_date:
+            months.append(current)
+            current = month_end + timedelta(days=1)
+        else:
+            days.append(current)
+            current += timedelta(days=1)
+    return months, days
+
+def top_spenders(session, start_date, end_date, limit):
+    """Return (id, name, total) for the `limit` biggest spenders in the date range."""
+    months, days = split_periods(start_date, end_date)
+    periods = [('month', m) for m in months] + [('day', d) for d in days]
+    if len(periods) == 1:
+        # 單一完整期間直接走 (period_kind, period_start, amount_sum) 索引
+        kind, start = periods[0]
+        query = (
+            select(User.id, User.name, UserSpend.amount_sum.label('total_transaction_amount'))
+            .join(User, User.id == UserSpend.user_id)
+            .where(UserSpend.period_kind == kind, UserSpend.period_start == start)
+            .order_by(UserSpend.amount_sum.desc(), User.id)
+        )
+    else:
+        conditions = []
+        if months:
+            conditions.append(and_(UserSpend.period_kind == 'month', UserSpend.period_start.in_(months)))
+        if days:
+            conditions.append(and_(UserSpend.period_kind == 'day', UserSpend.period_start.in_(days)))
+        total = func.sum(UserSpend.amount_sum)
+        query = (
+            select(User.id, User.name, total.label('total_transaction_amount'))
+            .join(User, User.id == UserSpend.user_id)
+            .where(or_(*conditions))
+            .group_by(User.id, User.name)
+            .order_by(total.desc(), User.id)
+        )
+    return session.execute(query.limit(limit)).all()
@@ -0,0 +1,133 @@
+"""Versioned migrations for the tables declared in models.py.
+
+    python schema.py          # upgrade the database at DATABASE_URL
+    python schema.py --sql    # print the PostgreSQL DDL of the current models
+
+models.py is the only definition of tables and indexes; each migration
+creates the objects it introduces from that metadata. Databases created
+before schema_version existed (by older etl.py runs) are upgraded in
+place, since every step only adds the tables, columns and indexes that
+are missing. Duplicate rows left by those runs stop the upgrade with an
+error naming them, since a unique index cannot be created over them.
+"""
+import argparse
+import logging
+from datetime import datetime
+from sqlalchemy import func, inspect, insert, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+from models import Base, SchemaVersion
+
+def add_missing_columns(conn):
+    # create_all 不會替既有資料表補欄位（例如 content_hash、source_key、stock）
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def check_unique(conn, index):
+    """Raise with the offending values when existing rows would violate a new unique index."""
+    columns = [index.table.c[column.name] for column in index.columns]
+    count = func.count().label('count')
+    duplicates = conn.execute(
+        select(*columns, count)
+        .where(*[column.isnot(None) for column in columns])
+        .group_by(*columns)
+        .having(count > 1)
+        .limit(5)
+    ).all()
+    if duplicates:
+        names = ', '.join(column.name for column in columns)
+        examples = '; '.join(f"{tuple(row[:-1])} x{row[-1]}" for row in duplicates)
+        raise RuntimeError(
+            f"Cannot create unique index {index.name}: {index.table.name} has duplicate ({names}) rows, "
+            f"e.g. {examples}. They come from etl.py reruns before natural keys existed; "
+            f"delete or merge the duplicates (or reload into an empty database) and run schema.py again."
+        )
+
+def create_indexes(conn, names):
+    indexes = {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+    inspector = inspect(conn)
+    for name in names:
+        index = indexes[name]
+        # 舊版 etl.py 重跑會留下重複的資料，建立唯一索引前先檢查，避免只看到資料庫的錯誤
+        if index.unique and name not in {i['name'] for i in inspector.get_indexes(index.table.name)}:
+            check_unique(conn, index)
+        index.create(conn, checkfirst=True)
+
+def create_baseline(conn):
+    Base.metadata.create_all(conn)
+    add_missing_columns(conn)
+    create_indexes(conn, [
+        'ux_pharmacies_name',
+        'ux_masks_pharmacy_id_name',
+        'ux_users_name',
+        'ux_purchase_history_source_key',
+        'ix_opening_periods_weekday_start_end',
+        'ix_user_spend_period_amount',
+        'ix_idempotency_keys_created_at',
+    ])
+
+def create_query_indexes(conn):
+    create_indexes(conn, [
+        'ix_masks_pharmacy_id_price',
+        'ix_masks_price',
+        'ix_purchase_history_transaction_date',
+        'ix_purchase_history_user_id_transaction_date',
+    ])
+
+# (version, description, upgrade(conn))；只能往後新增，不可修改已發佈的版本
+MIGRATIONS = [
+    (1, 'tables, natural keys and rollup tables', create_baseline),
+    (2, 'indexes for endpoint filters and rollup rebuilds', create_query_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def applied_versions(conn):
+    if not inspect(conn).has_table(SchemaVersion.__tablename__):
+        return set()
+    return set(conn.execute(select(SchemaVersion.version)).scalars())
+
+def migrate(engine):
+    """Apply pending migrations in order, each in its own transaction; return the versions applied."""
+    with engine.begin() as conn:
+        SchemaVersion.__table__.create(conn, checkfirst=True)
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        with engine.begin() as conn:
+            if version in applied_versions(conn):
+                continue
+            upgrade(conn)
+            conn.execute(insert(SchemaVersion).values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+        logging.info(f"Applied schema migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+def ddl(dialect=None):
+    """CREATE TABLE / CREATE INDEX statements for the current models."""
+    dialect = dialect or postgresql.dialect()
+    statements = []
+    for table in Base.metadata.sorted_tables:
+        statements.append(str(CreateTable(table).compile(dialect=dialect)).strip())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            statements.append(str(CreateIndex(index).compile(dialect=dialect)).strip())
+    return ';\n\n'.join(statements) + ';\n'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create or upgrade the database schema.')
+    parser.add_argument('--sql', action='store_true', help='print the PostgreSQL DDL instead of touching the database')
+    args = parser.parse_args()
+    if args.sql:
+        print(ddl())
+    else:
+        from db import engine
+        applied = migrate(engine)
+        print(f"Schema at version {LATEST_VERSION} (applied: {', '.join(map(str, applied)) or 'none'})")
@@ -0,0 +1,88 @@
+import logging
+import threading
+from sqlalchemy import text
+
+NGRAM_SIZE = 3
+
+def ngrams(value, n=NGRAM_SIZE):
+    return {value[i:i + n] for i in range(len(value) - n + 1)}
+
+class NgramIndex:
+    """In-process trigram inverted index over (id, name) pairs.
+
+    candidates() returns the ids whose lower-cased name contains the
+    lower-cased query, the same rows ILIKE '%query%' would match without
+    wildcard characters. The index is built lazily and rebuilt after
+    invalidate(); queries shorter than the n-gram size fall back to a scan
+    of the in-memory names.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._state = None
+        # invalidate() 遞增；讀取期間有變更時不保存過期的索引
+        self._generation = 0
+
+    def build(self):
+        with self._build_lock:
+            return self._build()
+
+    def _build(self):
+        with self._lock:
+            generation = self._generation
+        names = {}
+        postings = {}
+        for row_id, name in self._loader():
+            name = (name or '').lower()
+            names[row_id] = name
+            for gram in ngrams(name):
+                postings.setdefault(gram, set()).add(row_id)
+        state = (names, postings)
+        with self._lock:
+            if self._generation == generation:
+                self._state = state
+        return state
+
+    def _get_state(self):
+        state = self._state
+        if state is None:
+            with self._build_lock:
+                state = self._state or self._build()
+        return state
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+            self._generation += 1
+
+    @property
+    def is_built(self):
+        return self._state is not None
+
+    def candidates(self, query):
+        names, postings = self._get_state()
+        query = query.lower()
+        if len(query) < NGRAM_SIZE:
+            return sorted(row_id for row_id, name in names.items() if query in name)
+        grams = sorted(ngrams(query), key=lambda gram: len(postings.get(gram, ())))
+        matches = set(postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not matches:
+                break
+            matches &= postings.get(gram, set())
+        # 三字元組全部命中不代表連續出現，仍需比對完整字串
+        return sorted(row_id for row_id in matches if query in names[row_id])
+
+def ensure_trgm_indexes(engine):
+    # PostgreSQL 上以 pg_trgm GIN 索引支援 ILIKE '%query%'
+    if engine.dialect.name != 'postgresql':
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_pharmacies_name_trgm ON pharmacies USING gin (name gin_trgm_ops)'))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_masks_name_trgm ON masks USING gin (name gin_trgm_ops)'))
+    except Exception as e:
+        logging.warning(f"Could not create pg_trgm indexes: {e}")
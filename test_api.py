@@ -1,12 +1,43 @@
 import pytest
+import asyncio
+import gc
+import importlib
+import os
+import re
+import runpy
+import sys
+import threading
+import time
 import json
-from app import app, expand_days, parse_opening_hours, is_open, is_pharmacy_open
+import uuid
+from types import SimpleNamespace
+import etl
+import app as app_module
+import fastjson
+import metrics
+from app import app, idempotency_purge, response_cache, search_indexes, expand_days, parse_opening_hours, is_open, is_pharmacy_open, schedule_index, load_pharmacies, query_open_pharmacies, Session
+from opening_hours import ScheduleIndex, compile_periods
+from models import IdempotencyKey, Mask, MaskSalesDaily, Pharmacy, PurchaseHistory, User, UserSpend
+from idempotency import purge_expired_keys, request_fingerprint
+import response_cache as cache_tags
+from response_cache import ResponseCache, bump_versions
+from db import engine, make_engine, pool_options, pool_stats, read_engine, run_concurrently
+from rollups import rebuild_rollups, split_periods
+from datetime import date, timedelta
+from decimal import Decimal
+from search_index import NgramIndex
+from pagination import NUMBER, decode_cursor, encode_cursor
+from schema import MIGRATIONS, ddl, migrate
+from benchmark import ROUTES as BENCHMARK_ROUTES, RequestPlan, client_sender, compare, percentile, run_benchmark, summarize
+from sqlalchemy import create_engine, delete, event, func, insert, inspect, update
+from sqlalchemy.orm import Session as OrmSession
 from unittest.mock import patch
 from datetime import datetime
 
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
+    response_cache.clear()
     with app.test_client() as client:
         yield client
 
@@ -183,7 +214,7 @@ def test_list_open_pharmacies_invalid_time_format(client):
     assert b'Invalid time format' in rv.data
 
 def test_search_internal_error(client):
-    with patch('app.Session') as mock_session:
+    with patch('app.ReadSession') as mock_session:
         mock_session.side_effect = Exception("DB error")
         rv = client.get('/search?query=test')
         assert rv.status_code == 500
@@ -211,7 +242,8 @@ def test_is_pharmacy_open_with_bad_data():
 
 from unittest.mock import MagicMock
 def test_db_query_exception_handling(client):
-    with patch('app.Session') as mock_session:
+    schedule_index.invalidate()
+    with patch('app.ReadSession') as mock_session:
         mock_session.side_effect = Exception("DB error")
         rv = client.get('/pharmacies/open?time=10:00')
         assert rv.status_code == 500
@@ -305,6 +337,16 @@ def test_purchase_success(client):
     assert data["total_amount"] > 0
     assert data["remaining_balance"] >= 0
 
+def test_purchase_empty_items(client):
+    with Session() as session:
+        balance = float(session.get(User, 1).cash_balance)
+        history = session.query(PurchaseHistory).count()
+    res = client.post("/purchase", json={"user_id": 1, "items": []})
+    assert res.status_code == 200
+    assert res.get_json() == {"user_id": 1, "total_amount": 0.0, "remaining_balance": balance}
+    with Session() as session:
+        assert session.query(PurchaseHistory).count() == history
+
 def test_purchase_missing_payload(client):
     res = client.post("/purchase", data="", content_type="application/json")
     assert res.status_code == 400
@@ -344,6 +386,25 @@ def test_purchase_invalid_quantity(client):
     data = res.get_json()
     assert "Each item must include pharmacy_id, mask_id, and positive quantity" in data["error"]
 
+def test_purchase_string_ids(client):
+    payload = {"user_id": 1, "items": [{"pharmacy_id": "1", "mask_id": "1", "quantity": 1}]}
+    res = client.post("/purchase", json=payload)
+    assert res.status_code == 200
+    assert res.get_json()["total_amount"] > 0
+
+@pytest.mark.parametrize("item", [
+    {"pharmacy_id": 1, "mask_id": [1], "quantity": 1},
+    {"pharmacy_id": [1], "mask_id": 1, "quantity": 1},
+    {"pharmacy_id": 1, "mask_id": True, "quantity": 1},
+    {"pharmacy_id": 1, "mask_id": "one", "quantity": 1},
+    {"pharmacy_id": 1, "mask_id": 1, "quantity": "1"},
+    [1, 1, 1],
+])
+def test_purchase_invalid_item_values(client, item):
+    res = client.post("/purchase", json={"user_id": 1, "items": [item]})
+    assert res.status_code == 400
+    assert "Each item must include pharmacy_id, mask_id, and positive quantity" in res.get_json()["error"]
+
 def test_purchase_mask_pharmacy_mismatch(client):
     payload = {
         "user_id": 1,
@@ -391,3 +452,1206 @@ def test_purchase_pharmacy_or_mask_not_found(client):
     assert res.status_code == 404
     data = res.get_json()
     assert "Pharmacy or mask not found" in data["error"]
+
+def test_purchase_multi_item_credits_pharmacies(client):
+    with Session() as session:
+        masks = session.query(Mask).order_by(Mask.pharmacy_id.desc(), Mask.id).all()
+        first, second = masks[0], next(m for m in masks if m.pharmacy_id != masks[0].pharmacy_id)
+        user_before = float(session.get(User, 3).cash_balance)
+        pharmacy_before = {p.id: float(p.cash_balance) for p in session.query(Pharmacy).filter(
+            Pharmacy.id.in_([first.pharmacy_id, second.pharmacy_id]))}
+    schedule_index.build()
+    payload = {"user_id": 3, "items": [
+        {"pharmacy_id": first.pharmacy_id, "mask_id": first.id, "quantity": 1},
+        {"pharmacy_id": second.pharmacy_id, "mask_id": second.id, "quantity": 2},
+        {"pharmacy_id": first.pharmacy_id, "mask_id": first.id, "quantity": 1},
+    ]}
+    res = client.post("/purchase", data=json.dumps(payload), content_type="application/json")
+    assert res.status_code == 200
+    data = res.get_json()
+    first_amount, second_amount = 2 * float(first.price), 2 * float(second.price)
+    assert data["total_amount"] == pytest.approx(first_amount + second_amount)
+    assert data["remaining_balance"] == pytest.approx(user_before - first_amount - second_amount)
+    with Session() as session:
+        assert float(session.get(User, 3).cash_balance) == pytest.approx(data["remaining_balance"])
+        assert float(session.get(Pharmacy, first.pharmacy_id).cash_balance) == pytest.approx(
+            pharmacy_before[first.pharmacy_id] + first_amount)
+        assert float(session.get(Pharmacy, second.pharmacy_id).cash_balance) == pytest.approx(
+            pharmacy_before[second.pharmacy_id] + second_amount)
+        assert session.query(PurchaseHistory).filter(PurchaseHistory.user_id == 3).count() >= 3
+    cached = {row["id"]: row["cash_balance"] for row in schedule_index.iter_open(None, None)}
+    assert cached[first.pharmacy_id] == pytest.approx(pharmacy_before[first.pharmacy_id] + first_amount)
+
+def test_purchase_insufficient_balance_leaves_data_unchanged(client):
+    with Session() as session:
+        before = float(session.get(User, 1).cash_balance), float(session.get(Pharmacy, 1).cash_balance)
+        history = session.query(PurchaseHistory).count()
+    payload = {"user_id": 1, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1000000}]}
+    res = client.post("/purchase", data=json.dumps(payload), content_type="application/json")
+    assert res.status_code == 400
+    with Session() as session:
+        assert (float(session.get(User, 1).cash_balance), float(session.get(Pharmacy, 1).cash_balance)) == before
+        assert session.query(PurchaseHistory).count() == history
+
+@pytest.fixture
+def stocked_mask():
+    with Session() as session:
+        mask = session.query(Mask).filter(Mask.pharmacy_id == 1).order_by(Mask.id).first()
+        mask.stock = 3
+        session.commit()
+        mask_id = mask.id
+    yield mask_id
+    with Session() as session:
+        session.get(Mask, mask_id).stock = None
+        session.commit()
+
+def test_purchase_decrements_stock(client, stocked_mask):
+    payload = {"user_id": 2, "items": [{"pharmacy_id": 1, "mask_id": stocked_mask, "quantity": 2}]}
+    res = client.post("/purchase", data=json.dumps(payload), content_type="application/json")
+    assert res.status_code == 200
+    with Session() as session:
+        assert session.get(Mask, stocked_mask).stock == 1
+
+def test_purchase_insufficient_stock_rolls_back(client, stocked_mask):
+    with Session() as session:
+        balance = float(session.get(User, 2).cash_balance)
+    payload = {"user_id": 2, "items": [
+        {"pharmacy_id": 1, "mask_id": stocked_mask, "quantity": 2},
+        {"pharmacy_id": 1, "mask_id": stocked_mask, "quantity": 2},
+    ]}
+    res = client.post("/purchase", data=json.dumps(payload), content_type="application/json")
+    assert res.status_code == 409
+    assert res.get_json()["error"] == f"Insufficient stock for mask {stocked_mask}"
+    with Session() as session:
+        assert session.get(Mask, stocked_mask).stock == 3
+        assert float(session.get(User, 2).cash_balance) == balance
+
+def test_pharmacy_masks_in_stock_filter(client, stocked_mask):
+    with Session() as session:
+        pharmacy_name = session.get(Pharmacy, 1).name
+        session.get(Mask, stocked_mask).stock = 0
+        session.commit()
+    all_masks = client.get(f"/pharmacies/{pharmacy_name}/masks").get_json()
+    in_stock = client.get(f"/pharmacies/{pharmacy_name}/masks?in_stock=true").get_json()
+    assert stocked_mask in [m["id"] for m in all_masks]
+    assert [m for m in all_masks if m["id"] != stocked_mask] == in_stock
+    assert client.get(f"/pharmacies/{pharmacy_name}/masks?in_stock=yes").status_code == 400
+
+def _purchase(client, payload, key):
+    return client.post("/purchase", data=json.dumps(payload), content_type="application/json",
+                       headers={"Idempotency-Key": key})
+
+def test_purchase_idempotency_key_replays_response(client):
+    key = f"test-{uuid.uuid4()}"
+    payload = {"user_id": 4, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    first = _purchase(client, payload, key)
+    assert first.status_code == 200
+    with Session() as session:
+        balance = float(session.get(User, 4).cash_balance)
+        history = session.query(PurchaseHistory).count()
+    replay = _purchase(client, payload, key)
+    assert replay.status_code == 200
+    assert replay.get_json() == first.get_json()
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    with Session() as session:
+        assert float(session.get(User, 4).cash_balance) == balance
+        assert session.query(PurchaseHistory).count() == history
+
+    payload["items"][0]["quantity"] = 2
+    assert _purchase(client, payload, key).status_code == 422
+
+def test_purchase_idempotency_key_not_kept_on_failure(client):
+    key = f"test-{uuid.uuid4()}"
+    payload = {"user_id": 4, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1000000}]}
+    assert _purchase(client, payload, key).status_code == 400
+    with Session() as session:
+        assert session.get(IdempotencyKey, key) is None
+    payload["items"][0]["quantity"] = 1
+    assert _purchase(client, payload, key).status_code == 200
+
+def test_purchase_expired_idempotency_key_runs_again(client):
+    key = f"test-{uuid.uuid4()}"
+    payload = {"user_id": 4, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    assert _purchase(client, payload, key).status_code == 200
+    with Session() as session:
+        session.get(IdempotencyKey, key).created_at = datetime.utcnow() - timedelta(days=2)
+        session.commit()
+        history = session.query(PurchaseHistory).count()
+    res = _purchase(client, payload, key)
+    assert "Idempotent-Replayed" not in res.headers
+    with Session() as session:
+        assert session.query(PurchaseHistory).count() == history + 1
+        session.get(IdempotencyKey, key).created_at = datetime.utcnow() - timedelta(days=2)
+        session.commit()
+        assert purge_expired_keys(session, datetime.utcnow() - timedelta(days=1)) >= 1
+        session.commit()
+        assert session.get(IdempotencyKey, key) is None
+
+def test_purchase_concurrent_duplicate_waits_and_replays():
+    key = f"test-{uuid.uuid4()}"
+    payload = {"user_id": 4, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    with Session() as session:
+        history = session.query(PurchaseHistory).count()
+    claimed = threading.Event()
+    original = app_module.record_purchases
+
+    def slow_record_purchases(session, purchases):
+        # 第一個請求已取得 key、尚未提交時，讓重複的請求送出
+        claimed.set()
+        time.sleep(0.5)
+        return original(session, purchases)
+
+    responses = {}
+
+    def send(name):
+        if name == "duplicate":
+            claimed.wait(5)
+        with app.test_client() as client:
+            res = _purchase(client, payload, key)
+            responses[name] = (res.status_code, res.get_json(), res.headers.get("Idempotent-Replayed"), time.monotonic())
+
+    with patch("app.record_purchases", side_effect=slow_record_purchases):
+        threads = [threading.Thread(target=send, args=(name,)) for name in ("first", "duplicate")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+    first, duplicate = responses["first"], responses["duplicate"]
+    assert first[:3] == (200, first[1], None)
+    # 重複的請求在 INSERT 上等待第一個交易提交，之後回傳同一個結果而不是 409
+    assert duplicate[:3] == (200, first[1], "true")
+    assert duplicate[3] >= first[3]
+    with Session() as session:
+        assert session.query(PurchaseHistory).count() == history + 1
+
+def test_purchase_idempotency_key_without_response_is_rejected(client):
+    # claim 與購買在同一個交易提交，正常情況看不到未完成的 key；這個分支只是防護
+    key = f"test-{uuid.uuid4()}"
+    payload = {"user_id": 4, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    with Session() as session:
+        session.add(IdempotencyKey(key=key, request_hash=request_fingerprint(payload), created_at=datetime.utcnow()))
+        session.commit()
+    res = _purchase(client, payload, key)
+    assert res.status_code == 409
+    assert "still in progress" in res.get_json()["error"]
+    with Session() as session:
+        session.delete(session.get(IdempotencyKey, key))
+        session.commit()
+
+def test_purchase_idempotency_key_too_long(client):
+    payload = {"user_id": 4, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    assert _purchase(client, payload, "k" * 256).status_code == 400
+
+# ---------- 營業時間索引測試 ----------
+
+def test_compile_periods_splits_cross_midnight():
+    periods = compile_periods("Mon, Wed 20:00 - 02:00 / Tue 08:00 - 17:00")
+    assert (0, 1200, 1439) in periods
+    assert (0, 0, 120) in periods
+    assert (1, 480, 1020) in periods
+    assert (2, 1200, 1439) in periods
+
+def test_schedule_index_matches_is_pharmacy_open():
+    schedule_index.invalidate()
+    pharmacies = load_pharmacies()
+    for day in ["Mon", "tuesday", "Wed", "thu", "Fri", "sat", "Sunday", "xyz"]:
+        for time_str in ["00:00", "01:59", "02:00", "02:01", "08:00", "12:00", "17:00", "17:01", "20:00", "23:59"]:
+            check_time = datetime.strptime(time_str, "%H:%M").time()
+            expected = [p.id for p in sorted(pharmacies, key=lambda p: p.id) if is_pharmacy_open(p, check_time, day)]
+            assert [p["id"] for p in schedule_index.open_at(day, check_time)] == expected
+
+def test_schedule_index_rebuilds_after_invalidate():
+    schedule_index.build()
+    assert schedule_index.is_built
+    schedule_index.invalidate()
+    assert not schedule_index.is_built
+    rv = app.test_client().get('/pharmacies/open?time=10:00&day=Mon')
+    assert rv.status_code == 200
+    assert schedule_index.is_built
+
+@pytest.fixture
+def other_process_session():
+    """Session on a separate engine: its Core writes fire no mapper events in this process."""
+    other = create_engine(engine.url)
+    with OrmSession(other) as session:
+        yield session
+    other.dispose()
+
+def test_indexes_follow_writes_from_other_processes(client, monkeypatch, other_process_session):
+    monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", "ngram")
+    monkeypatch.setattr(response_cache, "poll_interval", 0)
+    session = other_process_session
+    open_url = "/pharmacies/open?time=10:00&day=Mon"
+    assert client.get(open_url).status_code == 200
+    assert client.get("/search?query=Zebra").get_json()["masks"] == []
+    assert schedule_index.is_built and search_indexes[Mask].is_built
+    old_cash = float(session.get(Pharmacy, 1).cash_balance)
+    try:
+        # 只改現金：重新讀取 cash_balance，不重編營業時間
+        session.execute(update(Pharmacy).where(Pharmacy.id == 1).values(cash_balance=old_cash + 1000))
+        bump_versions(session, [cache_tags.PHARMACY_CASH])
+        session.commit()
+        cash = {p["id"]: p["cash_balance"] for p in client.get("/pharmacies/open").get_json()}
+        assert cash[1] == pytest.approx(old_cash + 1000)
+
+        pharmacy_id = session.execute(insert(Pharmacy).values(
+            name="Zebra Night Pharmacy", cash_balance=10, opening_hours="Mon - Sun 00:00 - 23:59"
+        ).returning(Pharmacy.id)).scalar()
+        session.execute(insert(Mask).values(name="Zebra Mask (black) (1 per pack)", price=1, pharmacy_id=pharmacy_id))
+        bump_versions(session, [cache_tags.PHARMACIES, cache_tags.MASKS])
+        session.commit()
+        assert pharmacy_id in [p["id"] for p in client.get(open_url).get_json()]
+        data = client.get("/search?query=Zebra").get_json()
+        assert [p["name"] for p in data["pharmacies"]] == ["Zebra Night Pharmacy"]
+        assert [m["name"] for m in data["masks"]] == ["Zebra Mask (black) (1 per pack)"]
+    finally:
+        session.rollback()
+        session.execute(delete(Mask).where(Mask.name == "Zebra Mask (black) (1 per pack)"))
+        session.execute(delete(Pharmacy).where(Pharmacy.name == "Zebra Night Pharmacy"))
+        session.execute(update(Pharmacy).where(Pharmacy.id == 1).values(cash_balance=old_cash))
+        bump_versions(session, [cache_tags.PHARMACIES, cache_tags.PHARMACY_CASH, cache_tags.MASKS])
+        session.commit()
+        client.get(open_url)
+
+def test_open_pharmacies_sql_backend(client):
+    pharmacies = sorted(load_pharmacies(), key=lambda p: p.id)
+    with Session() as session:
+        for day in ["Mon", "Wed", "Fri", "Sun", "xyz"]:
+            for time_str in ["01:00", "02:01", "09:30", "20:30"]:
+                check_time = datetime.strptime(time_str, "%H:%M").time()
+                schedule = lambda p: parse_opening_hours(p.opening_hours)
+                expected = [p.id for p in pharmacies if is_open(schedule(p), day[:3].capitalize(), time_str)]
+                assert [p['id'] for p in query_open_pharmacies(session, day, check_time)] == expected
+        assert len(query_open_pharmacies(session, None, datetime.now().time())) == len(pharmacies)
+    app.config['OPEN_HOURS_BACKEND'] = 'sql'
+    try:
+        rv = client.get('/pharmacies/open?time=01:00&day=Mon')
+    finally:
+        app.config['OPEN_HOURS_BACKEND'] = 'index'
+    assert rv.status_code == 200
+    assert len(rv.get_json()) > 0
+
+# ---------- 每日銷售彙總測試 ----------
+
+def _rollup_snapshot(session):
+    return sorted(
+        (str(r.day), r.pharmacy_id, r.mask_id, r.tx_count, round(r.amount_sum, 2))
+        for r in session.query(MaskSalesDaily).all()
+    )
+
+def _user_spend_snapshot(session):
+    return sorted(
+        (r.period_kind, str(r.period_start), r.user_id, r.tx_count, round(r.amount_sum, 2))
+        for r in session.query(UserSpend).all()
+    )
+
+def test_mask_stats_matches_purchase_history(client):
+    with Session() as session:
+        count, amount = session.query(
+            func.count(PurchaseHistory.id), func.sum(PurchaseHistory.transaction_amount)
+        ).filter(func.date(PurchaseHistory.transaction_date).between('2021-01-01', '2021-01-31')).one()
+    res = client.get("/masks/stats?start_date=2021-01-01&end_date=2021-01-31")
+    assert res.status_code == 200
+    assert res.get_json()["total_mask_count"] == count
+    assert res.get_json()["total_transaction_amount"] == pytest.approx(amount)
+
+def test_purchase_updates_sales_rollup(client):
+    payload = {"user_id": 2, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    res = client.post("/purchase", data=json.dumps(payload), content_type="application/json")
+    assert res.status_code == 200
+    with Session() as session:
+        maintained = _rollup_snapshot(session), _user_spend_snapshot(session)
+        rebuild_rollups(session)
+        assert (_rollup_snapshot(session), _user_spend_snapshot(session)) == maintained
+        session.rollback()
+
+def test_split_periods():
+    months, days = split_periods(date(2021, 1, 30), date(2021, 4, 2))
+    assert months == [date(2021, 2, 1), date(2021, 3, 1)]
+    assert days == [date(2021, 1, 30), date(2021, 1, 31), date(2021, 4, 1), date(2021, 4, 2)]
+    assert split_periods(date(2021, 2, 1), date(2021, 2, 28)) == ([date(2021, 2, 1)], [])
+
+@pytest.mark.parametrize("start_date,end_date", [
+    ("2021-01-01", "2021-01-31"),
+    ("2021-01-10", "2021-01-10"),
+    ("2021-01-05", "2021-02-20"),
+    ("2020-12-15", "2021-12-31"),
+])
+def test_top_users_matches_purchase_history(client, start_date, end_date):
+    with Session() as session:
+        total = func.sum(PurchaseHistory.transaction_amount)
+        expected = (
+            session.query(User.id, total)
+            .join(PurchaseHistory, User.id == PurchaseHistory.user_id)
+            .filter(func.date(PurchaseHistory.transaction_date).between(start_date, end_date))
+            .group_by(User.id)
+            .order_by(total.desc(), User.id)
+            .limit(3)
+            .all()
+        )
+    res = client.get(f"/users/top_by_transaction_amount?start_date={start_date}&end_date={end_date}&x=3")
+    assert res.status_code == 200
+    data = res.get_json()
+    assert [u["id"] for u in data] == [row[0] for row in expected]
+    assert [u["total_transaction_amount"] for u in data] == pytest.approx([row[1] for row in expected])
+
+# ---------- /search 三字元組索引測試 ----------
+
+def schedule_rows(cash_balance):
+    return [SimpleNamespace(id=1, name="P", cash_balance=cash_balance, opening_hours="Mon 08:00 - 12:00")]
+
+def test_schedule_index_keeps_invalidate_during_build():
+    loads = []
+
+    def loader():
+        loads.append(1)
+        if len(loads) == 1:
+            # 讀取途中資料變更：這次讀到的結果不能被快取
+            index.invalidate()
+            return schedule_rows(1.0)
+        return schedule_rows(2.0)
+
+    index = ScheduleIndex(loader)
+    assert [row["cash_balance"] for row in index.iter_open(None, None)] == [1.0]
+    assert not index.is_built
+    assert [row["cash_balance"] for row in index.iter_open(None, None)] == [2.0]
+    assert index.is_built and len(loads) == 2
+
+def test_schedule_index_keeps_invalidate_fields_during_build():
+    cash = {"value": 1.0}
+
+    def loader():
+        rows = schedule_rows(cash["value"])
+        cash["value"] = 2.0
+        index.invalidate_fields()
+        return rows
+
+    index = ScheduleIndex(loader, lambda: {1: {"cash_balance": cash["value"]}})
+    list(index.iter_open(None, None))
+    assert [row["cash_balance"] for row in index.iter_open(None, None)] == [2.0]
+
+def test_schedule_index_builds_once_for_concurrent_lookups():
+    loads = []
+
+    def loader():
+        loads.append(1)
+        time.sleep(0.1)
+        return schedule_rows(1.0)
+
+    index = ScheduleIndex(loader)
+    threads = [threading.Thread(target=lambda: list(index.iter_open(None, None))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+
+def test_ngram_index_candidates():
+    index = NgramIndex(lambda: [(1, "Carepoint"), (2, "First Care Rx"), (3, "Medlife"), (4, None)])
+    assert index.candidates("care") == [1, 2]
+    assert index.candidates("CARE RX") == [2]
+    assert index.candidates("e") == [1, 2, 3]
+    assert index.candidates("erac") == []
+    assert index.candidates("xyz") == []
+
+def test_ngram_index_keeps_invalidate_during_build():
+    loads = []
+
+    def loader():
+        loads.append(1)
+        if len(loads) == 1:
+            index.invalidate()
+            return [(1, "Old Care")]
+        return [(1, "New Care")]
+
+    index = NgramIndex(loader)
+    assert index.candidates("old") == [1]
+    assert not index.is_built
+    assert index.candidates("old") == [] and index.candidates("new") == [1]
+    assert len(loads) == 2
+
+@pytest.mark.parametrize("query", ["Care", "ca", "(green)", "pack", "x", "Mask", "zzzz"])
+def test_search_ngram_backend_matches_sql(client, query):
+    expected = client.get(f"/search?query={query}").get_json()
+    app.config['SEARCH_BACKEND'] = 'ngram'
+    try:
+        res = client.get(f"/search?query={query}")
+    finally:
+        app.config['SEARCH_BACKEND'] = 'sql'
+    assert res.status_code == 200
+    assert res.get_json() == expected
+
+@pytest.mark.parametrize("query,max_candidates", [("a", 500), ("ack", 0), ("ack", 500)])
+def test_search_ngram_falls_back_to_ilike_for_broad_queries(client, monkeypatch, query, max_candidates):
+    expected = client.get(f"/search?query={query}&limit=500").get_json()
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", "ngram")
+    monkeypatch.setitem(app.config, "SEARCH_NGRAM_MAX_CANDIDATES", max_candidates)
+    response_cache.clear()
+    with metrics.count_queries(engine, read_engine) as queries:
+        res = client.get(f"/search?query={query}&limit=500")
+    assert res.get_json() == expected
+    # 短查詢或候選太多時不送出 IN 清單
+    uses_in = any(" IN (" in statement for statement in queries.statements)
+    assert uses_in == (query == "ack" and max_candidates == 500)
+
+def test_search_ngram_fallback_treats_wildcards_literally(client, monkeypatch):
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", "ngram")
+    res = client.get("/search?query=%25")
+    assert res.get_json()["pharmacies"] == res.get_json()["masks"] == []
+
+# ---------- /search 分頁與串流測試 ----------
+
+def test_search_ranks_prefix_matches_first(client):
+    data = client.get("/search?query=ma&limit=500").get_json()
+    names = [m["name"].lower() for m in data["masks"]]
+    prefixed = [n.startswith("ma") for n in names]
+    assert prefixed == sorted(prefixed, reverse=True)
+    assert data["next_cursors"] == {"pharmacies": None, "masks": None}
+
+def test_search_cursor_pagination_walks_all_results(client):
+    full = client.get("/search?query=e&limit=500").get_json()
+    for section in ["pharmacies", "masks"]:
+        seen, cursor = [], None
+        while True:
+            url = f"/search?query=e&type={section}&limit=7" + (f"&{section}_cursor={cursor}" if cursor else "")
+            data = client.get(url).get_json()
+            assert set(data) == {section, "next_cursors"}
+            assert len(data[section]) <= 7
+            seen.extend(data[section])
+            cursor = data["next_cursors"][section]
+            if not cursor:
+                break
+        assert seen == full[section]
+
+def test_search_default_limit(client):
+    data = client.get("/search?query=e").get_json()
+    assert len(data["masks"]) == 50
+    assert data["next_cursors"]["masks"] is not None
+
+def test_search_ndjson_stream(client):
+    res = client.get("/search?query=Care&format=ndjson&limit=500")
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    expected = client.get("/search?query=Care&limit=500").get_json()
+    assert [l for l in lines if l["type"] == "pharmacies"] == [dict(p, type="pharmacies") for p in expected["pharmacies"]]
+    assert [l for l in lines if l["type"] == "masks"] == [dict(m, type="masks") for m in expected["masks"]]
+    assert lines[-1] == {"type": "next_cursors", "pharmacies": None, "masks": None}
+
+@pytest.mark.parametrize("args,error", [
+    ("limit=0", "limit must be a positive integer"),
+    ("masks_limit=abc", "limit must be a positive integer"),
+    ("masks_cursor=not-a-cursor", "invalid cursor"),
+    ("type=users", 'type must be "pharmacies" or "masks"'),
+    ("format=xml", 'format must be "json" or "ndjson"'),
+])
+def test_search_invalid_paging_params(client, args, error):
+    res = client.get(f"/search?query=Care&{args}")
+    assert res.status_code == 400
+    assert res.get_json()["error"] == error
+
+# ---------- keyset 分頁測試 ----------
+
+def _walk_pages(client, url, limit):
+    seen, cursor = [], None
+    while True:
+        res = client.get(url + f"&limit={limit}" + (f"&cursor={cursor}" if cursor else ""))
+        assert res.status_code == 200
+        assert len(res.get_json()) <= limit
+        seen.extend(res.get_json())
+        cursor = res.headers.get("X-Next-Cursor")
+        if not cursor:
+            return seen
+
+@pytest.mark.parametrize("sort_by,order", [("name", "asc"), ("name", "desc"), ("price", "asc"), ("price", "desc")])
+def test_pharmacy_masks_keyset_pagination(client, sort_by, order):
+    url = f"/pharmacies/First Care Rx/masks?sort_by={sort_by}&order={order}"
+    full = client.get(url)
+    assert "X-Next-Cursor" not in full.headers
+    assert _walk_pages(client, url, 2) == full.get_json()
+
+def test_pharmacy_masks_cursor_must_match_sort(client):
+    res = client.get("/pharmacies/First Care Rx/masks?sort_by=price&limit=1")
+    cursor = res.headers["X-Next-Cursor"]
+    res = client.get(f"/pharmacies/First Care Rx/masks?sort_by=name&cursor={cursor}")
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "invalid cursor"
+
+@pytest.mark.parametrize("backend", ["index", "sql"])
+@pytest.mark.parametrize("url, values", [
+    ("/pharmacies/open?time=10:00&limit=2", ["x"]),
+    ("/pharmacies/open?time=10:00&limit=2", [True]),
+    ("/pharmacies/open?time=10:00&limit=2", [2 ** 70]),
+    ("/pharmacies/First Care Rx/masks?sort_by=price&limit=1", ["price", "asc", "cheap", 1]),
+    ("/pharmacies/First Care Rx/masks?sort_by=name&limit=1", ["name", "asc", 3.5, 1]),
+    ("/pharmacies/First Care Rx/masks?sort_by=name&limit=1", ["name", "asc", "a", "1"]),
+    ("/pharmacies/First Care Rx/masks?sort_by=price&limit=1", ["price", "asc", 1, None]),
+])
+def test_cursor_values_must_have_expected_types(client, monkeypatch, backend, url, values):
+    monkeypatch.setitem(app.config, "OPEN_HOURS_BACKEND", backend)
+    res = client.get(f"{url}&cursor={encode_cursor(values)}")
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "invalid cursor"
+
+@pytest.mark.parametrize("backend", ["sql", "ngram"])
+@pytest.mark.parametrize("values", [[{"a": 1}, "b", 1], [0, "b", "1"], [0, None, 1], [0.5, "b", 1], [0, "b"]])
+def test_search_cursor_values_must_have_expected_types(client, monkeypatch, backend, values):
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", backend)
+    res = client.get(f"/search?query=a&limit=1&pharmacies_cursor={encode_cursor(values)}")
+    assert res.status_code == 400
+    assert res.get_json() == {"error": "invalid cursor"}
+
+def test_search_internal_error_hides_details(client):
+    with patch('app.search_pharmacies', side_effect=Exception("SELECT secret FROM pharmacies")):
+        res = client.get('/search?query=Care')
+    assert res.status_code == 500
+    assert res.get_json() == {"error": "Internal Server Error"}
+
+def test_decode_cursor_checks_value_types():
+    assert decode_cursor(encode_cursor(["price", "asc", 12.5, 7]), [str, str, NUMBER, int]) == ["price", "asc", 12.5, 7]
+    for values in ([1, 2.0], ["a", 1], [float("nan"), 1], [[1], 1]):
+        with pytest.raises(ValueError):
+            decode_cursor(encode_cursor(values), [NUMBER, int])
+
+@pytest.mark.parametrize("backend", ["index", "sql"])
+@pytest.mark.parametrize("query", ["time=09:00&day=Mon", "time=01:00&day=Fri", "time=10:00"])
+def test_open_pharmacies_keyset_pagination(client, backend, query):
+    app.config['OPEN_HOURS_BACKEND'] = backend
+    try:
+        full = client.get(f"/pharmacies/open?{query}").get_json()
+        assert _walk_pages(client, f"/pharmacies/open?{query}", 3) == full
+    finally:
+        app.config['OPEN_HOURS_BACKEND'] = 'index'
+
+def test_open_pharmacies_invalid_limit(client):
+    res = client.get("/pharmacies/open?time=10:00&limit=-3")
+    assert res.status_code == 400
+    assert res.get_json()["error"] == "limit must be a positive integer"
+
+# ---------- 回應快取測試 ----------
+
+def test_response_cache_hit_with_normalized_args(client):
+    first = client.get("/masks/stats?start_date=2021-01-01&end_date=2021-01-31")
+    second = client.get("/masks/stats?end_date=2021-01-31&start_date=2021-01-01")
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.get_json() == first.get_json()
+
+def test_response_cache_keeps_pagination_headers(client):
+    url = "/pharmacies/First Care Rx/masks?sort_by=price&limit=1"
+    first = client.get(url)
+    second = client.get(url)
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+
+def test_response_cache_skips_errors_and_streams(client):
+    assert client.get("/masks/stats?start_date=bad&end_date=2021-01-31").headers["X-Cache"] == "MISS"
+    assert client.get("/masks/stats?start_date=bad&end_date=2021-01-31").headers["X-Cache"] == "MISS"
+    client.get("/search?query=Care&format=ndjson")
+    assert client.get("/search?query=Care&format=ndjson").headers["X-Cache"] == "MISS"
+
+def test_purchase_invalidates_only_affected_entries(client):
+    stats_url = "/masks/stats?start_date=2000-01-01&end_date=2100-01-01"
+    masks_url = "/pharmacies/First Care Rx/masks"
+    before = client.get(stats_url).get_json()
+    client.get(masks_url)
+    payload = {"user_id": 5, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    assert client.post("/purchase", data=json.dumps(payload), content_type="application/json").status_code == 200
+    after = client.get(stats_url)
+    assert after.headers["X-Cache"] == "MISS"
+    assert after.get_json()["total_mask_count"] == before["total_mask_count"] + 1
+    assert client.get(masks_url).headers["X-Cache"] == "HIT"
+
+def test_response_cache_picks_up_data_versions(client):
+    url = "/masks/stats?start_date=2021-01-01&end_date=2021-12-31"
+    client.get(url)
+    poll_interval = response_cache.poll_interval
+    response_cache.poll_interval = 0
+    try:
+        assert client.get(url).headers["X-Cache"] == "HIT"
+        # 模擬其他 worker 或 etl.py 的寫入
+        with Session() as session:
+            bump_versions(session, ["sales"])
+            session.commit()
+        assert client.get(url).headers["X-Cache"] == "MISS"
+        assert client.get(url).headers["X-Cache"] == "HIT"
+    finally:
+        response_cache.poll_interval = poll_interval
+
+def test_response_cache_lru_and_size_limits():
+    cache = ResponseCache(max_entries=2, max_bytes=100)
+    for key in "abc":
+        assert cache.set(key, ["sales"], (0,), b"x" * 10)
+    assert cache.get("a") is None and len(cache) == 2
+    cache.get("b")
+    cache.set("d", ["masks"], (0,), b"x" * 10)
+    assert cache.get("b") is not None and cache.get("c") is None
+    assert not cache.set("big", ["masks"], (0,), b"x" * 101)
+    cache.set("e", ["masks"], (0,), b"x" * 90)
+    assert cache.size_bytes <= 100
+
+def test_response_cache_ttl_and_stale_generation():
+    cache = ResponseCache(ttl=0)
+    cache.set("a", ["sales"], (0,), b"x")
+    assert cache.get("a") is None
+    cache = ResponseCache()
+    generations = cache.generations(["sales"])
+    cache.invalidate(["sales"])
+    assert not cache.set("a", ["sales"], generations, b"x")
+    cache.set("b", ["sales"], cache.generations(["sales"]), b"x")
+    cache.set("c", ["masks"], cache.generations(["masks"]), b"x")
+    cache.invalidate(["sales"])
+    assert cache.get("b") is None and cache.get("c") is not None
+
+# ---------- ETag / 條件式 GET 測試 ----------
+
+def test_etag_not_modified_skips_query(client):
+    url = "/masks/stats?start_date=2021-01-01&end_date=2021-12-31"
+    first = client.get(url)
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "public, max-age=0, must-revalidate"
+    with patch('app.sales_totals', side_effect=Exception("should not run")):
+        res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.data == b""
+    assert res.headers["ETag"] == etag
+    assert client.get("/masks/stats?start_date=2021-01-01&end_date=2021-06-30").headers["ETag"] != etag
+
+def test_etag_changes_after_purchase(client):
+    stats_url = "/masks/stats?start_date=2021-01-01&end_date=2021-12-31"
+    masks_url = "/pharmacies/First Care Rx/masks"
+    stats_etag = client.get(stats_url).headers["ETag"]
+    masks_etag = client.get(masks_url).headers["ETag"]
+    payload = {"user_id": 5, "items": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    assert client.post("/purchase", data=json.dumps(payload), content_type="application/json").status_code == 200
+    res = client.get(stats_url, headers={"If-None-Match": stats_etag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != stats_etag
+    assert client.get(masks_url, headers={"If-None-Match": masks_etag}).status_code == 304
+
+def test_etag_without_response_cache(client):
+    app.config['RESPONSE_CACHE'] = False
+    try:
+        url = "/pharmacies/open?time=10:00"
+        first = client.get(url)
+        assert "X-Cache" not in first.headers
+        assert client.get(url, headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+        assert "ETag" not in client.get("/pharmacies/open?time=bad").headers
+    finally:
+        app.config['RESPONSE_CACHE'] = True
+
+# ---------- JSON 序列化測試 ----------
+
+def test_fastjson_backends_match_jsonify():
+    data = {"b": [{"price": 12.5, "name": "藥局", "stock": None}], "a": Decimal("3.25"), "next_cursors": {"masks": None}}
+    with app.test_request_context():
+        expected = json.loads(app.json_encoder().encode({**data, "a": 3.25}))
+    encoded = fastjson.dumps(data)
+    # 模擬未安裝 orjson，改用標準函式庫
+    try:
+        with patch.dict(sys.modules, {"orjson": None}):
+            fallback = importlib.reload(fastjson)
+            assert fallback.BACKEND == "json"
+            assert fallback.dumps(data) == encoded
+    finally:
+        importlib.reload(fastjson)
+    assert encoded.endswith(b"\n") and json.loads(encoded) == expected
+    # 與 jsonify 相同：鍵排序、無多餘空白
+    assert encoded.startswith(b'{"a":3.25,"b":[{"name":')
+
+def test_list_endpoints_keep_response_shape(client):
+    masks = client.get("/pharmacies/DFW%20Wellness/masks?sort_by=price&limit=2")
+    assert masks.mimetype == "application/json"
+    assert all(set(m) == {"id", "name", "price", "stock"} and isinstance(m["price"], float) for m in masks.get_json())
+    search = client.get("/search?query=a&limit=2").get_json()
+    assert set(search["pharmacies"][0]) == {"id", "name", "cash_balance", "opening_hours"}
+    assert set(search["masks"][0]) == {"id", "name", "price", "pharmacy_name"}
+
+def test_microbench_paths_agree(monkeypatch, capsys):
+    import microbench
+    monkeypatch.setattr(sys, "argv", ["microbench.py", "--pharmacies", "20", "--masks-per-pharmacy", "5", "--repeat", "1"])
+    microbench.main()
+    assert "/search" in capsys.readouterr().out
+
+# ---------- 資料庫連線設定測試 ----------
+
+def test_pool_options_from_env(monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "12")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "3")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "false")
+    options = pool_options()
+    assert (options["pool_size"], options["max_overflow"], options["pool_pre_ping"]) == (12, 3, False)
+
+def test_pool_stats_reports_both_engines(client):
+    client.get("/pharmacies/open?time=10:00")
+    stats = pool_stats()
+    assert set(stats) == {"write", "read"}
+    assert {"pool", "checkedin", "checkedout"} <= set(stats["read"])
+
+def metric_sample(text, name, **labels):
+    # 由 Prometheus 文字格式取出一個樣本值
+    for line in text.splitlines():
+        if line.startswith(name + "{") or line.startswith(name + " "):
+            sample, value = line.rsplit(" ", 1)
+            if all(f'{key}="{val}"' in sample for key, val in labels.items()):
+                return float(value)
+    return None
+
+def test_metrics_endpoint_records_route_latency_and_sql(client, monkeypatch):
+    monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+    with Session() as session:
+        pharmacy_name = session.get(Pharmacy, 1).name
+    route = "/pharmacies/<pharmacy_name>/masks"
+    before = client.get("/metrics").get_data(as_text=True)
+    assert client.get(f"/pharmacies/{pharmacy_name}/masks").status_code == 200
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.content_type == metrics.CONTENT_TYPE
+    text = res.get_data(as_text=True)
+    count = lambda text, name, **labels: metric_sample(text, name, **labels) or 0
+    # 以路由樣板作為標籤，不包含藥局名稱；/metrics 本身不計入
+    assert count(text, "http_request_duration_seconds_count", route=route, status="200") == \
+        count(before, "http_request_duration_seconds_count", route=route, status="200") + 1
+    assert count(text, "http_request_sql_statements_sum", route=route) >= \
+        count(before, "http_request_sql_statements_sum", route=route) + 2
+    assert count(text, "http_request_phase_seconds_count", route=route, phase="serialize") > 0
+    assert count(text, "http_response_size_bytes_count", route=route) > 0
+    assert count(text, "sql_statements_total", engine="write", operation="select") > 0
+    assert count(text, "db_pool_checkout_wait_seconds_count", engine="write") > 0
+    assert metric_sample(text, "db_pool_connections", engine="write", state="checkedout") is not None
+    assert 'route="/metrics"' not in text
+
+def test_metrics_histogram_exposition():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, route='/a"b')
+    lines = histogram.collect()
+    # bucket 為累計次數，上界包含等於的值；標籤值跳脫引號
+    assert 'test_seconds_bucket{route="/a\\"b",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{route="/a\\"b",le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{route="/a\\"b",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{route="/a\\"b"} 4' in lines
+    assert metric_sample("\n".join(lines), "test_seconds_sum") == pytest.approx(3.65)
+
+def test_gunicorn_hooks_warm_up_in_master(monkeypatch):
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    monkeypatch.setenv("GUNICORN_THREADS", "8")
+    config = runpy.run_path(os.path.join(os.path.dirname(__file__), "gunicorn.conf.py"))
+    assert (config["workers"], config["threads"], config["preload_app"]) == (3, 8, True)
+    schedule_index.invalidate()
+    try:
+        config["when_ready"](None)
+    finally:
+        gc.unfreeze()
+    # master 已建好索引，且沒有留下任何連線給 worker
+    assert schedule_index.is_built
+    assert pool_stats()["write"]["checkedin"] == 0
+    config["post_fork"](None, None)
+    assert schedule_index.is_built
+
+def test_forked_worker_keeps_master_indexes_until_data_changes(client, monkeypatch, other_process_session):
+    monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+    monkeypatch.setattr(response_cache, "poll_interval", 0)
+    # 模擬剛啟動、尚未輪詢過 data_versions 的 master
+    monkeypatch.setattr(response_cache, "_versions", None)
+    config = runpy.run_path(os.path.join(os.path.dirname(__file__), "gunicorn.conf.py"))
+    try:
+        config["when_ready"](None)
+    finally:
+        gc.unfreeze()
+    config["post_fork"](None, None)
+    # master 建立索引前已記下版本：worker 第一次輪詢沒有變更，不重建索引
+    with metrics.count_queries(engine, read_engine) as counter:
+        assert client.get("/pharmacies/open?time=10:00&day=Mon").status_code == 200
+    assert counter.count == 1
+    old_cash = float(other_process_session.get(Pharmacy, 1).cash_balance)
+    try:
+        other_process_session.execute(update(Pharmacy).where(Pharmacy.id == 1).values(cash_balance=old_cash + 1))
+        bump_versions(other_process_session, [cache_tags.PHARMACY_CASH])
+        other_process_session.commit()
+        cash = {p["id"]: p["cash_balance"] for p in client.get("/pharmacies/open").get_json()}
+        assert cash[1] == pytest.approx(old_cash + 1)
+    finally:
+        other_process_session.execute(update(Pharmacy).where(Pharmacy.id == 1).values(cash_balance=old_cash))
+        bump_versions(other_process_session, [cache_tags.PHARMACY_CASH])
+        other_process_session.commit()
+
+def test_get_handlers_use_read_session(client):
+    with patch('app.Session', side_effect=Exception("primary used")):
+        assert client.get("/masks/stats?start_date=2021-01-01&end_date=2021-01-31").status_code == 200
+        assert client.get("/search?query=Care").status_code == 200
+
+# ---------- schema 與查詢計畫測試 ----------
+
+def test_migrate_creates_schema_once():
+    target = create_engine("sqlite://")
+    assert migrate(target) == [version for version, _, _ in MIGRATIONS]
+    assert migrate(target) == []
+    indexes = {index["name"] for index in inspect(target).get_indexes("masks")}
+    assert {"ux_masks_pharmacy_id_name", "ix_masks_pharmacy_id_price", "ix_masks_price"} <= indexes
+
+def test_migrate_upgrades_database_created_before_versioning():
+    target = create_engine("sqlite://")
+    with target.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE masks (id INTEGER PRIMARY KEY, name VARCHAR, price FLOAT, pharmacy_id INTEGER)")
+        conn.exec_driver_sql(
+            "CREATE TABLE purchase_history (id INTEGER PRIMARY KEY, user_id INTEGER, mask_id INTEGER, "
+            "pharmacy_id INTEGER, transaction_amount FLOAT, transaction_date DATETIME)"
+        )
+        conn.exec_driver_sql("INSERT INTO masks (name, price, pharmacy_id) VALUES ('Old Mask', 5, 1)")
+    migrate(target)
+    inspector = inspect(target)
+    assert {"stock", "content_hash"} <= {column["name"] for column in inspector.get_columns("masks")}
+    assert {"ix_purchase_history_transaction_date", "ix_purchase_history_user_id_transaction_date"} <= {
+        index["name"] for index in inspector.get_indexes("purchase_history")
+    }
+    with target.connect() as conn:
+        assert conn.exec_driver_sql("SELECT name FROM masks").scalar() == "Old Mask"
+
+def test_migrate_reports_duplicates_from_old_etl_runs():
+    target = create_engine("sqlite://")
+    with target.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR, cash_balance FLOAT)")
+        conn.exec_driver_sql("INSERT INTO users (name, cash_balance) VALUES ('Alice', 1), ('Alice', 1), ('Bob', 2)")
+    with pytest.raises(RuntimeError, match=r"ux_users_name: users has duplicate \(name\) rows, e\.g\. \('Alice',\) x2"):
+        migrate(target)
+    with target.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM users WHERE id = 2")
+    assert migrate(target) == [version for version, _, _ in MIGRATIONS]
+
+def test_models_are_the_only_schema():
+    assert etl.Pharmacy is Pharmacy and etl.PurchaseHistory is PurchaseHistory
+    sql = ddl()
+    for index in ("ux_pharmacies_name", "ix_masks_price", "ix_purchase_history_user_id_transaction_date"):
+        assert f"INDEX {index} ON" in sql
+
+# 資料量成長後全表掃描代價高的資料表；data_versions、schema_version 只有少數幾列
+LARGE_TABLES = {
+    "pharmacies", "masks", "users", "purchase_history", "opening_periods",
+    "mask_sales_daily", "user_spend", "idempotency_keys",
+}
+
+def full_scans(conn, statement, parameters):
+    """Large tables that the plan of `statement` reads in full."""
+    if conn.dialect.name == "postgresql":
+        # 測試資料很少，關閉 seq scan 讓規劃器只要有可用的索引就會使用
+        with conn.begin():
+            conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            plan = [row[0] for row in conn.exec_driver_sql(f"EXPLAIN {statement}", parameters)]
+        return {table for line in plan for table in re.findall(r"Seq Scan on (\w+)", line) if table in LARGE_TABLES}
+    plan = [row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    # SQLite 的 SCAN（包含 USING COVERING INDEX）都會讀完整張表或整個索引
+    return {line.split()[1] for line in plan if line.startswith("SCAN ") and line.split()[1] in LARGE_TABLES}
+
+@pytest.fixture
+def executed_statements():
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters[0] if executemany else parameters))
+
+    engines = {engine, read_engine}
+    for target in engines:
+        event.listen(target, "before_cursor_execute", capture)
+    yield statements
+    for target in engines:
+        event.remove(target, "before_cursor_execute", capture)
+
+EXPLAIN_REQUESTS = [
+    "/pharmacies/open?time=10:00&day=Mon",
+    "/pharmacies/open?time=10:00&day=Mon&limit=2",
+    "/pharmacies/DFW%20Wellness/masks?sort_by=price&order=desc",
+    "/pharmacies/DFW%20Wellness/masks?in_stock=true&limit=1",
+    "/pharmacies/mask_count?min_price=10&max_price=20&count=1",
+    "/users/top_by_transaction_amount?start_date=2021-01-01&end_date=2021-01-31&x=3",
+    "/masks/stats?start_date=2021-01-05&end_date=2021-01-20",
+    "/search?query=Mask&limit=3",
+    "/purchase",
+]
+
+@pytest.mark.parametrize("url", EXPLAIN_REQUESTS)
+def test_endpoint_queries_avoid_full_scans(client, monkeypatch, stocked_mask, executed_statements, url):
+    monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+    monkeypatch.setitem(app.config, "OPEN_HOURS_BACKEND", "sql")
+    # SQLite 沒有 pg_trgm，'%query%' 只能掃描；改用三字元組索引取得候選 id
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", "sql" if engine.dialect.name == "postgresql" else "ngram")
+    for index in search_indexes.values():
+        index.build()
+    executed_statements.clear()
+    if url == "/purchase":
+        payload = {"user_id": 2, "items": [{"pharmacy_id": 1, "mask_id": stocked_mask, "quantity": 1}]}
+        res = client.post(url, json=payload, headers={"Idempotency-Key": str(uuid.uuid4())})
+    else:
+        res = client.get(url)
+    assert res.status_code == 200
+    statements = list(executed_statements)
+    assert statements
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            assert not full_scans(conn, statement, parameters), statement
+
+# ---------- SQL 語句數預算 ----------
+
+@pytest.fixture
+def query_count(client, monkeypatch):
+    """Send a request with every occasional query forced and return (response, statements executed)."""
+    monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+    # data_versions 輪詢、記憶體索引重建與過期 key 清除平常只在部分請求發生，預算以最壞情況計算
+    monkeypatch.setattr(response_cache, "poll_interval", 0)
+    monkeypatch.setattr(idempotency_purge, "due", lambda: True)
+
+    def run(method, url, **kwargs):
+        schedule_index.invalidate()
+        for index in search_indexes.values():
+            index.invalidate()
+        with metrics.count_queries(engine, read_engine) as counter:
+            res = client.open(url, method=method, **kwargs)
+            # 串流回應在讀取內容時才查詢
+            res.get_data()
+        return res, counter.statements
+    return run
+
+def purchase_request(items):
+    with Session() as session:
+        user_id = session.query(User.id).order_by(User.cash_balance.desc()).first()[0]
+        # 每家藥局各取最便宜的口罩，購物車跨多家藥局
+        masks = [
+            session.query(Mask).filter(Mask.pharmacy_id == pharmacy_id).order_by(Mask.price, Mask.id).first()
+            for (pharmacy_id,) in session.query(Pharmacy.id).order_by(Pharmacy.id).limit(items)
+        ]
+    payload = {"user_id": user_id, "items": [{"pharmacy_id": m.pharmacy_id, "mask_id": m.id, "quantity": 1} for m in masks]}
+    return "POST", "/purchase", {"json": payload, "headers": {"Idempotency-Key": str(uuid.uuid4())}}
+
+QUERY_BUDGET_REQUESTS = [
+    ("GET", "/metrics"),
+    ("GET", "/pharmacies/open?time=10:00&day=Mon"),
+    ("GET", "/pharmacies/open?time=10:00&day=Mon&limit=2"),
+    ("GET", "/pharmacies/DFW%20Wellness/masks?sort_by=price&order=desc"),
+    ("GET", "/pharmacies/DFW%20Wellness/masks?in_stock=true&limit=1"),
+    ("GET", "/pharmacies/mask_count?min_price=10&max_price=20&count=1"),
+    ("GET", "/users/top_by_transaction_amount?start_date=2021-01-01&end_date=2021-01-31&x=3"),
+    ("GET", "/masks/stats?start_date=2021-01-05&end_date=2021-01-20"),
+    ("GET", "/search?query=Mask&limit=3"),
+    ("GET", "/search?query=Mask&limit=3&format=ndjson"),
+    ("POST", "/purchase"),
+]
+
+# (OPEN_HOURS_BACKEND, SEARCH_BACKEND)：兩種設定的查詢數不同，預算要涵蓋兩者
+QUERY_BUDGET_BACKENDS = [("index", "sql"), ("sql", "ngram")]
+
+def route_budget(method, url):
+    endpoint, _ = app.url_map.bind("localhost").match(url.split("?")[0], method=method)
+    return app.view_functions[endpoint].query_budget
+
+def test_every_route_declares_a_query_budget():
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint != "static"}
+    for endpoint in endpoints:
+        assert isinstance(getattr(app.view_functions[endpoint], "query_budget", None), int), endpoint
+    covered = {app.url_map.bind("localhost").match(url.split("?")[0], method=method)[0] for method, url in QUERY_BUDGET_REQUESTS}
+    assert covered == endpoints
+
+@pytest.mark.parametrize("backends", QUERY_BUDGET_BACKENDS)
+@pytest.mark.parametrize("method, url", QUERY_BUDGET_REQUESTS)
+def test_endpoint_stays_within_query_budget(query_count, monkeypatch, stocked_mask, backends, method, url):
+    monkeypatch.setitem(app.config, "OPEN_HOURS_BACKEND", backends[0])
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", backends[1])
+    kwargs = {}
+    if method == "POST":
+        # 含有追蹤庫存的口罩時會多扣庫存、多遞增一個版本
+        _, _, kwargs = purchase_request(3)
+        kwargs["json"]["items"].append({"pharmacy_id": 1, "mask_id": stocked_mask, "quantity": 1})
+    res, statements = query_count(method, url, **kwargs)
+    assert res.status_code == 200
+    budget = route_budget(method, url)
+    assert len(statements) <= budget, f"{len(statements)} statements (budget {budget}):\n" + "\n\n".join(statements)
+
+# 同一路由以小、大兩種輸入各請求一次：查詢數相同，才不會隨資料量出現 N+1
+GROWTH_REQUESTS = [
+    ("/pharmacies/open?time=10:00&day=Mon&limit=1", "/pharmacies/open?time=10:00"),
+    ("/pharmacies/DFW%20Wellness/masks?limit=1", "/pharmacies/DFW%20Wellness/masks"),
+    ("/pharmacies/mask_count?min_price=10&max_price=11&count=1", "/pharmacies/mask_count?min_price=0&max_price=100&count=0"),
+    ("/users/top_by_transaction_amount?start_date=2021-01-01&end_date=2021-01-02&x=1",
+     "/users/top_by_transaction_amount?start_date=2021-01-01&end_date=2021-12-31&x=20"),
+    ("/masks/stats?start_date=2021-01-05&end_date=2021-01-05", "/masks/stats?start_date=2021-01-01&end_date=2021-12-31"),
+    # 大輸入仍用三個字元以上的查詢：ngram 後端對更短的查詢改走 ILIKE，少了重建索引的語句
+    ("/search?query=Mask&limit=1", "/search?query=ack&limit=50"),
+    ("/search?query=Mask&limit=1&format=ndjson", "/search?query=ack&limit=50&format=ndjson"),
+    ("purchase:1", "purchase:4"),
+]
+
+@pytest.mark.parametrize("backends", QUERY_BUDGET_BACKENDS)
+@pytest.mark.parametrize("small, large", GROWTH_REQUESTS)
+def test_endpoint_query_count_does_not_grow_with_input(query_count, monkeypatch, backends, small, large):
+    monkeypatch.setitem(app.config, "OPEN_HOURS_BACKEND", backends[0])
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", backends[1])
+    counts = []
+    for request in (small, large):
+        if request.startswith("purchase:"):
+            method, url, kwargs = purchase_request(int(request.split(":")[1]))
+        else:
+            method, url, kwargs = "GET", request, {}
+        res, statements = query_count(method, url, **kwargs)
+        assert res.status_code == 200
+        counts.append(len(statements))
+    assert counts[0] == counts[1], f"{small}: {counts[0]} statements, {large}: {counts[1]}"
+
+def test_count_queries_counts_each_engine_once():
+    with metrics.count_queries(engine, read_engine, engine) as counter:
+        with engine.connect() as conn:
+            conn.exec_driver_sql("SELECT 1")
+    assert counter.count == 1
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SELECT 1")
+    assert counter.count == 1
+
+# ---------- 基準測試工具測試 ----------
+
+def test_benchmark_percentiles_and_summary():
+    values = [i / 1000 for i in range(1, 101)]
+    assert (percentile(values, 50), percentile(values, 95), percentile(values, 99)) == (0.05, 0.095, 0.099)
+    assert percentile([0.004], 99) == 0.004 and percentile([], 50) is None
+    summary = summarize(values, 0, 2.0)
+    assert (summary["requests"], summary["throughput_rps"], summary["p95_ms"]) == (100, 50.0, 95.0)
+
+def test_benchmark_compare_flags_regressions():
+    baseline = {"routes": {"GET /search": {"p95_ms": 10.0, "throughput_rps": 100.0, "errors": 0}}}
+    steady = {"routes": {"GET /search": {"p95_ms": 12.0, "throughput_rps": 90.0, "errors": 0}}}
+    slower = {"routes": {"GET /search": {"p95_ms": 13.0, "throughput_rps": 70.0, "errors": 2}}}
+    assert compare(steady, baseline) == []
+    assert len(compare(slower, baseline)) == 3
+    assert compare(slower, baseline, max_latency_increase=1, max_throughput_drop=0.5) == ["GET /search: 2 failed requests"]
+
+def test_benchmark_reports_routes_without_requests(capsys):
+    baseline = {"routes": {"GET /search": {"p95_ms": 10.0, "throughput_rps": 100.0, "errors": 0}}}
+    empty = {"routes": {"GET /search": summarize([], 0, 0)}}
+    assert compare(empty, baseline) == ["GET /search: no completed requests"]
+    with Session() as session:
+        plan = RequestPlan.from_database(session, seed=1)
+    results = run_benchmark(client_sender(app), plan, ["GET /search"], requests=0, concurrency=1, warmup=0)
+    assert results["GET /search"]["requests"] == 0
+    assert "GET /search" in capsys.readouterr().out
+
+def test_benchmark_plan_requires_data():
+    target = create_engine("sqlite://")
+    migrate(target)
+    with OrmSession(target) as session:
+        with pytest.raises(ValueError, match="no pharmacies, masks, users in the database"):
+            RequestPlan.from_database(session)
+
+def test_benchmark_drives_every_route(monkeypatch):
+    monkeypatch.setitem(app.config, "RESPONSE_CACHE", False)
+    with Session() as session:
+        plan = RequestPlan.from_database(session, seed=1)
+    method, path, body, headers = plan.request("POST /purchase")
+    assert (method, path, body["items"][0]["quantity"]) == ("POST", "/purchase", 1) and "Idempotency-Key" in headers
+    # /purchase 會改動資料，這裡只跑唯讀路由
+    routes = [route for route in BENCHMARK_ROUTES if route.startswith("GET ")]
+    results = run_benchmark(client_sender(app), plan, routes, requests=6, concurrency=3, warmup=1)
+    assert set(results) == set(routes)
+    assert all(r["requests"] == 6 and r["errors"] == 0 and r["p50_ms"] <= r["p99_ms"] for r in results.values())
+
+# ---------- ASGI 模式測試 ----------
+
+ASGI_URLS = [
+    "/pharmacies/open?time=10:00&day=Mon",
+    "/pharmacies/open?time=10:00&limit=3",
+    "/pharmacies/open?time=99:99",
+    "/pharmacies/First Care Rx/masks?sort_by=price&order=desc&limit=2",
+    "/pharmacies/Nowhere/masks",
+    "/pharmacies/mask_count?min_price=10&max_price=30&count=2&threshold=gt",
+    "/users/top_by_transaction_amount?start_date=2021-01-01&end_date=2021-12-31&x=5",
+    "/masks/stats?start_date=2021-01-01&end_date=2021-12-31",
+    "/masks/stats?start_date=bad&end_date=2021-12-31",
+    "/search?query=Care&limit=2",
+    "/search?query=Care&format=ndjson",
+]
+
+def _asgi_request(application, method, url, body=b"", headers=()):
+    path, _, query = url.partition("?")
+    scope = {
+        "type": "http", "method": method, "path": path, "root_path": "", "query_string": query.encode(),
+        "http_version": "1.1", "scheme": "http", "server": ("localhost", 80), "client": ("127.0.0.1", 1234),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    return scope, receive, send, messages
+
+def test_make_engine_keeps_in_memory_sqlite_database():
+    memory_engine = make_engine("sqlite://", name="memory")
+    try:
+        assert type(memory_engine.pool).__name__ == "TimedSingletonThreadPool"
+        with memory_engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE t (id INTEGER)")
+        with memory_engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT count(*) FROM t").scalar() == 0
+        assert metrics.POOL_WAIT.count(engine="memory") >= 2
+    finally:
+        memory_engine.dispose()
+
+@pytest.mark.parametrize("url", ["sqlite:////tmp/pool.db", "postgresql+psycopg2://user@localhost/db"])
+def test_make_engine_uses_queue_pool_options(url):
+    queue_engine = make_engine(url, name="queue")
+    assert type(queue_engine.pool).__name__ == "TimedQueuePool"
+    assert queue_engine.pool.size() == pool_options()["pool_size"]
+
+@pytest.fixture
+def asgi_application():
+    # aiosqlite 與 asyncpg 都列在 requirements.txt，兩種資料庫都必須執行這組測試
+    from asgi import application
+    return application
+
+@pytest.mark.parametrize("url", ["sqlite+aiosqlite:////tmp/pool.db", "postgresql+asyncpg://user@localhost/db"])
+def test_async_engine_pool_options_match_dialect(url):
+    from asgi import make_async_engine
+    from sqlalchemy.engine import make_url
+    async_engine = make_async_engine(make_url(url))
+    pool = async_engine.sync_engine.pool
+    if url.startswith("postgresql"):
+        assert pool.size() == pool_options()["pool_size"]
+    else:
+        assert type(pool).__name__ == "NullPool"
+
+def test_asgi_matches_flask_responses(client, asgi_application):
+    async def run_all():
+        responses = []
+        try:
+            for url in ASGI_URLS:
+                scope, receive, send, messages = _asgi_request(asgi_application, "GET", url)
+                await asgi_application(scope, receive, send)
+                responses.append(messages)
+            scope, receive, send, messages = _asgi_request(
+                asgi_application, "POST", "/purchase", b'{"user_id": 999999, "items": []}',
+                [("Content-Type", "application/json")])
+            await asgi_application(scope, receive, send)
+            responses.append(messages)
+        finally:
+            await asgi_application.dispose()
+        return responses
+
+    app.config['RESPONSE_CACHE'] = False
+    try:
+        async_responses = asyncio.run(run_all())
+        for url, messages in zip(ASGI_URLS + ["/purchase"], async_responses):
+            if url == "/purchase":
+                expected = client.post(url, data='{"user_id": 999999, "items": []}', content_type="application/json")
+            else:
+                expected = client.get(url)
+            headers = {k.decode(): v.decode() for k, v in messages[0]["headers"]}
+            body = b"".join(m.get("body", b"") for m in messages[1:])
+            assert messages[0]["status"] == expected.status_code, url
+            assert body == expected.data, url
+            for name in ("content-type", "etag", "x-next-cursor"):
+                assert headers.get(name) == expected.headers.get(name), (url, name)
+    finally:
+        app.config['RESPONSE_CACHE'] = True
+
+def test_run_concurrently_without_event_loop():
+    assert run_concurrently(lambda: 1, lambda: 2) == [1, 2]
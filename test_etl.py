@@ -0,0 +1,357 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import pytest
+import etl
+from etl import iter_json_array, batched, mask_fields
+from generate_data import DatasetGenerator, SampleProfile, write_json_array
+from models import Mask, MaskSalesDaily, OpeningPeriod, Pharmacy, PurchaseHistory, User, UserSpend
+from opening_hours import compile_periods
+from schema import migrate
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+def write_json(tmp_path, text):
+    path = tmp_path / "data.json"
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 1 << 16])
+def test_iter_json_array_matches_json_load(chunk_size):
+    for file_path in ["data/pharmacies.json", "data/users.json"]:
+        with open(file_path, encoding="utf-8") as f:
+            expected = json.load(f)
+        assert list(iter_json_array(file_path, chunk_size)) == expected
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1 << 16])
+def test_iter_json_array_scalars_and_whitespace(tmp_path, chunk_size):
+    path = write_json(tmp_path, ' \n[ 12345 , "a,]b" ,\n{"x": [1, 2]}, -1.5e3 ,null ]\n')
+    assert list(iter_json_array(path, chunk_size)) == [12345, "a,]b", {"x": [1, 2]}, -1.5e3, None]
+
+def test_iter_json_array_empty(tmp_path):
+    assert list(iter_json_array(write_json(tmp_path, "[ ]"))) == []
+
+def test_iter_json_array_rejects_non_array(tmp_path):
+    with pytest.raises(ValueError):
+        list(iter_json_array(write_json(tmp_path, '{"a": 1}')))
+
+def test_iter_json_array_truncated(tmp_path):
+    with pytest.raises(ValueError):
+        list(iter_json_array(write_json(tmp_path, '[{"a": 1}, {"b"'), chunk_size=4))
+
+def count_raw_decode(monkeypatch):
+    calls = []
+    raw_decode = json.JSONDecoder.raw_decode
+    monkeypatch.setattr(json.JSONDecoder, "raw_decode", lambda self, s, idx=0: calls.append(idx) or raw_decode(self, s, idx))
+    return calls
+
+def test_iter_json_array_large_element_parses_in_few_attempts(tmp_path, monkeypatch):
+    record = {"name": "x" * 50000, "purchaseHistories": [{"maskName": f"mask {i}", "transactionAmount": i} for i in range(5000)]}
+    path = write_json(tmp_path, json.dumps([record, record]))
+    calls = count_raw_decode(monkeypatch)
+    assert list(iter_json_array(path, 16)) == [record, record]
+    # 每次重試前未解析的部分至少加倍，嘗試次數是對數而不是元素大小 / chunk_size
+    assert len(calls) < 40
+
+def test_iter_json_array_malformed_element_fails_without_reading_ahead(tmp_path, monkeypatch):
+    path = write_json(tmp_path, '[{"a": 1 x}, ' + ", ".join(['{"b": "' + "y" * 100 + '"}'] * 10000) + "]")
+    calls = count_raw_decode(monkeypatch)
+    with pytest.raises(ValueError):
+        list(iter_json_array(path, 64))
+    assert len(calls) == 1
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 3)) == []
+
+def test_mask_fields_stock(monkeypatch):
+    untracked = mask_fields({"name": "A", "price": 1.5})
+    assert untracked["stock"] is None
+    assert mask_fields({"name": "A", "price": 1.5, "stock": 7})["stock"] == 7
+    monkeypatch.setattr(etl, "DEFAULT_STOCK", 10)
+    seeded = mask_fields({"name": "A", "price": 1.5})
+    assert seeded["stock"] == 10
+    assert seeded["content_hash"] != untracked["content_hash"]
+
+# ---------- 合成資料產生器測試 ----------
+
+@pytest.fixture(scope="module")
+def profile():
+    return SampleProfile.load(etl.PHARMACIES_JSON, etl.USERS_JSON)
+
+def test_generator_is_deterministic_and_streamable(tmp_path, profile):
+    paths = []
+    for run in range(2):
+        generator = DatasetGenerator(profile, pharmacies=60, users=50, seed=3)
+        path = str(tmp_path / f"users{run}.json")
+        assert write_json_array(path, generator.users()) == 50
+        paths.append(path)
+    with open(paths[0], encoding="utf-8") as a, open(paths[1], encoding="utf-8") as b:
+        assert a.read() == b.read()
+    assert len(list(iter_json_array(paths[0], chunk_size=64))) == 50
+    other = DatasetGenerator(profile, pharmacies=60, users=50, seed=4)
+    assert other.user(0) != DatasetGenerator(profile, pharmacies=60, users=50, seed=3).user(0)
+
+def test_generated_records_are_loadable(profile):
+    generator = DatasetGenerator(profile, pharmacies=60, users=200, seed=1)
+    pharmacies = list(generator.pharmacies())
+    users = list(generator.users())
+    # etl.py 的自然鍵：藥局名稱、使用者名稱、同藥局的口罩名稱、使用者名稱|交易時間
+    assert len({p["name"] for p in pharmacies}) == 60
+    assert len({u["name"] for u in users}) == 200
+    catalogue = {p["name"]: {m["name"] for m in p["masks"]} for p in pharmacies}
+    for pharmacy in pharmacies:
+        assert len(catalogue[pharmacy["name"]]) == len(pharmacy["masks"]) > 0
+        assert compile_periods(pharmacy["openingHours"])
+    for user in users:
+        dates = [h["transactionDate"] for h in user["purchaseHistories"]]
+        assert len(set(dates)) == len(dates)
+        for history in user["purchaseHistories"]:
+            assert history["maskName"] in catalogue[history["pharmacyName"]]
+    counts = [len(u["purchaseHistories"]) for u in users]
+    assert min(profile.purchase_counts) <= min(counts) and max(counts) <= max(profile.purchase_counts)
+
+# ---------- 匯入模式測試（以子行程對暫存 SQLite 執行 etl.py） ----------
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory, profile):
+    out = tmp_path_factory.mktemp("dataset")
+    generator = DatasetGenerator(profile, pharmacies=40, users=150, seed=5)
+    write_json_array(str(out / "pharmacies.json"), generator.pharmacies())
+    write_json_array(str(out / "users.json"), generator.users())
+    return {"pharmacies": str(out / "pharmacies.json"), "users": str(out / "users.json")}
+
+def run_etl(database_url, dataset, *args, check=True):
+    result = subprocess.run(
+        [sys.executable, "etl.py", "--pharmacies", dataset["pharmacies"], "--users", dataset["users"], *args],
+        cwd=ROOT, env=dict(os.environ, DATABASE_URL=database_url), capture_output=True, text=True
+    )
+    if check:
+        assert result.returncode == 0, result.stdout + result.stderr
+    return result
+
+def sql_statements(output):
+    return int(re.search(r"SQL \(main process\): (\d+) statements", output).group(1))
+
+def snapshot(database_url):
+    """Every loaded row keyed by natural keys instead of ids, so different load modes can be compared."""
+    engine = create_engine(database_url)
+    queries = {
+        "pharmacies": select(Pharmacy.name, Pharmacy.cash_balance, Pharmacy.opening_hours, Pharmacy.content_hash),
+        "masks": select(Pharmacy.name, Mask.name, Mask.price, Mask.stock, Mask.content_hash)
+            .join(Pharmacy, Mask.pharmacy_id == Pharmacy.id),
+        "opening_periods": select(Pharmacy.name, OpeningPeriod.weekday, OpeningPeriod.start_minute, OpeningPeriod.end_minute)
+            .join(Pharmacy, OpeningPeriod.pharmacy_id == Pharmacy.id),
+        "users": select(User.name, User.cash_balance, User.content_hash),
+        "purchase_history": select(
+            PurchaseHistory.source_key, User.name, Pharmacy.name, Mask.name, PurchaseHistory.transaction_amount,
+            PurchaseHistory.transaction_date, PurchaseHistory.content_hash
+        ).join(User, PurchaseHistory.user_id == User.id).join(Mask, PurchaseHistory.mask_id == Mask.id)
+            .join(Pharmacy, PurchaseHistory.pharmacy_id == Pharmacy.id),
+        "mask_sales_daily": select(MaskSalesDaily.day, Pharmacy.name, Mask.name, MaskSalesDaily.tx_count, MaskSalesDaily.amount_sum)
+            .join(Mask, MaskSalesDaily.mask_id == Mask.id).join(Pharmacy, MaskSalesDaily.pharmacy_id == Pharmacy.id),
+        "user_spend": select(UserSpend.period_kind, UserSpend.period_start, User.name, UserSpend.tx_count, UserSpend.amount_sum)
+            .join(User, UserSpend.user_id == User.id),
+    }
+    with engine.connect() as conn:
+        result = {
+            table: sorted((tuple(round(v, 6) if isinstance(v, float) else v for v in row) for row in conn.execute(query)), key=repr)
+            for table, query in queries.items()
+        }
+    engine.dispose()
+    return result
+
+def test_bulk_load_matches_default_mode(tmp_path, dataset):
+    default_url, bulk_url = f"sqlite:///{tmp_path / 'default.db'}", f"sqlite:///{tmp_path / 'bulk.db'}"
+    run_etl(default_url, dataset)
+    output = run_etl(bulk_url, dataset, "--bulk", "--stream", "--batch-size", "50").stdout
+    expected = snapshot(default_url)
+    assert all(expected.values())
+    assert snapshot(bulk_url) == expected
+    # 每批固定幾個語句（含 migration 與彙總表），不因 RETURNING 退化成逐列 INSERT
+    rows = len(expected["pharmacies"]) + len(expected["masks"]) + len(expected["users"])
+    assert sql_statements(output) < rows
+
+def change_stats(output):
+    return {
+        table: tuple(map(int, counts))
+        for table, *counts in re.findall(r"^(\w+): .*\n  inserted=(\d+) updated=(\d+) unchanged=(\d+)", output, re.M)
+    }
+
+def edited_dataset(dataset, tmp_path, edit):
+    with open(dataset["pharmacies"], encoding="utf-8") as f:
+        pharmacies = json.load(f)
+    with open(dataset["users"], encoding="utf-8") as f:
+        users = json.load(f)
+    edit(pharmacies, users)
+    paths = {"pharmacies": str(tmp_path / "pharmacies.json"), "users": str(tmp_path / "users.json")}
+    write_json_array(paths["pharmacies"], pharmacies)
+    write_json_array(paths["users"], users)
+    return paths
+
+def test_incremental_rerun_is_a_noop(tmp_path, dataset):
+    url = f"sqlite:///{tmp_path / 'etl.db'}"
+    first = change_stats(run_etl(url, dataset, "--incremental", "--batch-size", "50").stdout)
+    assert first["pharmacies"][0] == 40 and first["users"][0] == 150
+    before = snapshot(url)
+    second = change_stats(run_etl(url, dataset, "--incremental", "--batch-size", "50").stdout)
+    assert set(second) == {"pharmacies", "masks", "users", "purchase_history"}
+    for table, (inserted, updated, unchanged) in second.items():
+        assert (inserted, updated) == (0, 0), table
+        assert unchanged == sum(first[table])
+    assert snapshot(url) == before
+
+def test_incremental_updates_only_changed_rows(tmp_path, dataset):
+    url = f"sqlite:///{tmp_path / 'etl.db'}"
+    run_etl(url, dataset, "--incremental")
+    before = snapshot(url)
+
+    def edit(pharmacies, users):
+        pharmacies[3]["openingHours"] = "Sat, Sun 22:00 - 06:00"
+        pharmacies[7]["masks"][0]["price"] = 999.5
+    paths = edited_dataset(dataset, tmp_path, edit)
+    with open(paths["pharmacies"], encoding="utf-8") as f:
+        pharmacies = json.load(f)
+    stats = change_stats(run_etl(url, paths, "--incremental").stdout)
+    assert stats["pharmacies"] == (0, 1, 39)
+    assert stats["masks"][:2] == (0, 1)
+    assert stats["users"][:2] == stats["purchase_history"][:2] == (0, 0)
+
+    after = snapshot(url)
+    changed_pharmacy, changed_mask = pharmacies[3]["name"], (pharmacies[7]["name"], pharmacies[7]["masks"][0]["name"])
+    for table in ("users", "purchase_history", "mask_sales_daily", "user_spend"):
+        assert after[table] == before[table], table
+    assert set(after["pharmacies"]) - set(before["pharmacies"]) == {
+        row for row in after["pharmacies"] if row[0] == changed_pharmacy
+    }
+    assert {row[:2] for row in set(after["masks"]) - set(before["masks"])} == {changed_mask}
+    # 只有營業時間改變的藥局重建 opening_periods
+    periods = lambda rows, match: sorted(row[1:] for row in rows if (row[0] == changed_pharmacy) == match)
+    assert periods(after["opening_periods"], True) == sorted(compile_periods("Sat, Sun 22:00 - 06:00"))
+    assert periods(after["opening_periods"], False) == periods(before["opening_periods"], False)
+
+def test_incremental_rebuilds_rollups_for_touched_days(tmp_path, dataset):
+    url = f"sqlite:///{tmp_path / 'etl.db'}"
+    run_etl(url, dataset, "--incremental")
+    before = snapshot(url)
+    changed = {}
+
+    def edit(pharmacies, users):
+        history = next(u for u in users if u["purchaseHistories"])["purchaseHistories"][0]
+        history["transactionAmount"] = round(history["transactionAmount"] + 100, 2)
+        changed["day"] = history["transactionDate"][:10]
+    paths = edited_dataset(dataset, tmp_path, edit)
+    stats = change_stats(run_etl(url, paths, "--incremental").stdout)
+    assert stats["purchase_history"][:2] == (0, 1)
+    after = snapshot(url)
+
+    # 部分重建的結果必須與整個重建相同，且只有被修改那一天的彙總列改變
+    full_url = f"sqlite:///{tmp_path / 'full.db'}"
+    shutil.copy(tmp_path / "etl.db", tmp_path / "full.db")
+    run_etl(full_url, paths, "--rebuild-rollups")
+    rebuilt = snapshot(full_url)
+    assert after["mask_sales_daily"] == rebuilt["mask_sales_daily"]
+    assert after["user_spend"] == rebuilt["user_spend"]
+    assert {str(row[0]) for row in set(after["mask_sales_daily"]) ^ set(before["mask_sales_daily"])} == {changed["day"]}
+    assert {str(row[1]) for row in set(after["user_spend"]) ^ set(before["user_spend"])} == {changed["day"], changed["day"][:8] + "01"}
+
+def test_parallel_load_matches_serial_bulk_load(tmp_path, dataset):
+    serial_url, parallel_url = f"sqlite:///{tmp_path / 'serial.db'}", f"sqlite:///{tmp_path / 'parallel.db'}"
+    run_etl(serial_url, dataset, "--bulk")
+    output = run_etl(parallel_url, dataset, "--workers", "2", "--batch-size", "20").stdout
+    assert "(2 workers)" in output
+    assert snapshot(parallel_url) == snapshot(serial_url)
+
+@pytest.fixture
+def etl_database(tmp_path, monkeypatch):
+    # 讓 etl 模組（與 fork 出的 worker）改用暫存資料庫
+    engine = create_engine(f"sqlite:///{tmp_path / 'etl.db'}")
+    migrate(engine)
+    Session = sessionmaker(bind=engine)
+    monkeypatch.setattr(etl, "engine", engine)
+    monkeypatch.setattr(etl, "Session", Session)
+    monkeypatch.setattr(etl, "session", Session())
+    yield engine
+    etl.session.close()
+    engine.dispose()
+
+def test_parallel_load_raises_when_counts_disagree(etl_database, dataset, monkeypatch):
+    mask_map = etl.bulk_etl_pharmacies(etl.read_records(dataset["pharmacies"], True), 50)
+    # 找不到 partition 的資料列：workers 回報的筆數與實際寫入不符
+    monkeypatch.setattr(etl, "count_loaded", lambda names, source_keys: (0, 0))
+    with pytest.raises(RuntimeError, match=r"users: expected 150 rows, workers reported 150, found 0"):
+        etl.parallel_etl_users(mask_map, etl.read_records(dataset["users"], True), 2, 40)
+
+load_users_partition = etl.load_users_partition
+
+def load_partition_with_concurrent_purchase(batch, batch_size):
+    counts = load_users_partition(batch, batch_size)
+    # 同時有其他寫入者（例如 /purchase 或另一個 ETL）新增資料列
+    user_id = etl.insert_by_name(User, [{"name": f"Concurrent {batch[0]['name']}", "cash_balance": 1}])[0]
+    etl.session.add(PurchaseHistory(user_id=user_id, mask_id=1, pharmacy_id=1, transaction_amount=1))
+    etl.session.commit()
+    return counts
+
+def test_parallel_load_ignores_concurrent_writes(etl_database, dataset, monkeypatch):
+    mask_map = etl.bulk_etl_pharmacies(etl.read_records(dataset["pharmacies"], True), 50)
+    monkeypatch.setattr(etl, "load_users_partition", load_partition_with_concurrent_purchase)
+    etl.parallel_etl_users(mask_map, etl.read_records(dataset["users"], True), 2, 40)
+    with etl_database.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(User)).scalar() == 150 + 4
+
+def test_purchase_source_keys_number_same_second_purchases():
+    user = {"name": "Ann", "purchaseHistories": [
+        {"transactionDate": "2021-01-04 15:18:51"}, {"transactionDate": "2021-01-04 15:18:51"},
+        {"transactionDate": "2021-01-05 09:00:00"}, {"transactionDate": "2021-01-04 15:18:51"},
+    ]}
+    assert etl.purchase_source_keys(user) == [
+        "Ann|2021-01-04 15:18:51", "Ann|2021-01-04 15:18:51|2", "Ann|2021-01-05 09:00:00", "Ann|2021-01-04 15:18:51|3",
+    ]
+
+@pytest.mark.parametrize("mode", [[], ["--bulk"], ["--incremental"]])
+def test_basket_purchases_in_the_same_second_load(tmp_path, dataset, mode):
+    # /purchase 一次買多個口罩時，每個品項是一列且交易時間相同
+    def edit(pharmacies, users):
+        user = next(u for u in users if u["purchaseHistories"])
+        first = user["purchaseHistories"][0]
+        masks = [m["name"] for p in pharmacies for m in p["masks"] if m["name"] != first["maskName"]]
+        user["purchaseHistories"][1:1] = [dict(first, maskName=masks[0]), dict(first, maskName=masks[1])]
+    paths = edited_dataset(dataset, tmp_path, edit)
+    url = f"sqlite:///{tmp_path / 'etl.db'}"
+    run_etl(url, paths, *mode)
+    with open(paths["users"], encoding="utf-8") as f:
+        users = json.load(f)
+    rows = snapshot(url)["purchase_history"]
+    assert len(rows) == len({row[0] for row in rows}) == sum(len(u["purchaseHistories"]) for u in users)
+    if mode == ["--incremental"]:
+        stats = change_stats(run_etl(url, paths, *mode).stdout)
+        assert stats["purchase_history"][:2] == (0, 0)
+
+def test_incremental_keeps_live_stock(tmp_path, dataset):
+    url = f"sqlite:///{tmp_path / 'etl.db'}"
+    run_etl(url, dataset, "--incremental", "--stock", "10")
+    changed = {}
+
+    def edit(pharmacies, users):
+        untracked, tracked = pharmacies[7]["masks"][0], pharmacies[8]["masks"][0]
+        untracked["price"] = 999.5
+        tracked["price"] = 888.5
+        tracked["stock"] = 50
+        changed["untracked"] = (pharmacies[7]["name"], untracked["name"])
+        changed["tracked"] = (pharmacies[8]["name"], tracked["name"])
+    paths = edited_dataset(dataset, tmp_path, edit)
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        # 模擬 /purchase 扣過庫存
+        conn.execute(Mask.__table__.update().values(stock=3))
+    engine.dispose()
+    run_etl(url, paths, "--incremental", "--stock", "10")
+    masks = {row[:2]: row[2:4] for row in snapshot(url)["masks"]}
+    assert masks[changed["untracked"]] == (999.5, 3)
+    assert masks[changed["tracked"]] == (888.5, 50)
+    assert sum(1 for price, stock in masks.values() if stock != 3) == 1